@@ -0,0 +1,155 @@
+"""
+Пакетная (офлайн) проверка релевантности базы знаний через OpenAI Batch API
+
+Batch API обрабатывает запросы в течение 24 часов за половину стоимости
+и с отдельными лимитами - подходит для массовых проверок, а не для ответов в боте.
+
+Запуск: python ai_batch.py questions.txt [--output report.json]
+(questions.txt - тестовые вопросы, по одному на строку)
+"""
+import argparse
+import asyncio
+import io
+import json
+from typing import Dict, List, Optional
+
+import config
+import ai_helper
+
+# Статусы пакета, после которых он больше не изменится
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def build_relevance_requests(pairs: List[tuple], model: Optional[str] = None) -> List[dict]:
+    """
+    Собирает тела запросов проверки релевантности для пакета
+
+    Args:
+        pairs: Список пар (вопрос пользователя, найденный вопрос)
+        model: Модель (по умолчанию OPENAI_MODEL)
+    """
+    model = ai_helper.validate_model(model or config.OPENAI_MODEL)
+    return [
+        {
+            "model": model,
+            "messages": [{"role": "user", "content": ai_helper.RELEVANCE_PROMPT_TEMPLATE.format(user_question, found_question)}],
+            "max_tokens": 1,
+            "temperature": 0,
+        }
+        for user_question, found_question in pairs
+    ]
+
+async def submit_batch(requests: List[dict]) -> str:
+    """
+    Загружает запросы в формате JSONL и создает пакет
+
+    Returns:
+        Идентификатор пакета; custom_id запроса - "r<номер в списке>"
+    """
+    client = ai_helper.get_client()
+    jsonl = "\n".join(
+        json.dumps({"custom_id": f"r{i}", "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False)
+        for i, body in enumerate(requests)
+    )
+    batch_file = await client.files.create(file=("batch.jsonl", io.BytesIO(jsonl.encode())), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+async def wait_for_batch(batch_id: str, min_delay: float = 5.0, max_delay: float = 300.0):
+    """Опрашивает пакет с экспоненциально растущей паузой, пока он не завершится"""
+    client = ai_helper.get_client()
+    delay = min_delay
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            return batch
+        print(f"[INFO] Batch {batch_id}: {batch.status}, next check in {delay:.0f} s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+async def fetch_results(batch) -> Dict[str, Optional[str]]:
+    """
+    Скачивает результаты завершенного пакета
+
+    Returns:
+        custom_id -> текст ответа модели (None для запросов с ошибкой)
+    """
+    if batch.status != 'completed' or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}'")
+
+    content = await ai_helper.get_client().files.content(batch.output_file_id)
+    results = {}
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            results[item["custom_id"]] = None
+            continue
+        results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+async def validate_knowledge_base(questions: List[str]) -> List[dict]:
+    """
+    Ищет каждый тестовый вопрос в базе знаний и проверяет лучший найденный ответ пакетом
+
+    Returns:
+        Отчет: вопрос, найденный вопрос (None - не найден) и оценка AI (None - ошибка)
+    """
+    # Импорт здесь: qa_bot создает экземпляр бота при импорте
+    from qa_bot import search_in_knowledge_base
+
+    report = []
+    pairs = []
+    for question in questions:
+        results = search_in_knowledge_base(question)
+        found_question = results[0]['question'] if results else None
+        report.append({'question': question, 'found_question': found_question, 'relevant': None})
+        if found_question:
+            pairs.append((len(report) - 1, question, found_question))
+
+    if not pairs:
+        return report
+
+    batch_id = await submit_batch(build_relevance_requests([(q, f) for _, q, f in pairs]))
+    print(f"[INFO] Batch {batch_id} submitted: {len(pairs)} requests")
+    results = await fetch_results(await wait_for_batch(batch_id))
+
+    for i, (index, _, _) in enumerate(pairs):
+        answer = results.get(f"r{i}")
+        if answer is not None:
+            report[index]['relevant'] = answer.startswith(('Y', 'y'))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная проверка релевантности базы знаний через OpenAI Batch API")
+    parser.add_argument("questions", help="Файл с тестовыми вопросами, по одному на строку")
+    parser.add_argument("--output", help="Сохранить отчет в JSON файл")
+    args = parser.parse_args()
+
+    if not config.AI_CONFIG['enabled']:
+        print("[ERROR] OPENAI_API_KEY не задан - пакетная проверка недоступна")
+        return
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    report = asyncio.run(validate_knowledge_base(questions))
+
+    for item in report:
+        if item['found_question'] is None:
+            status = "NOT FOUND"
+        else:
+            status = {True: "OK", False: "NOT RELEVANT", None: "ERROR"}[item['relevant']]
+        print(f"[{status}] {item['question']} -> {item['found_question']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
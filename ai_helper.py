@@ -1,68 +1,52 @@
 """
 Модуль для работы с внешним AI (OpenAI) как fallback
 """
+import asyncio
+import contextlib
+import re
+import threading
 import config
+import httpx
 import openai
+import tiktoken
+from aiolimiter import AsyncLimiter
 from openai import APIError
-from typing import Optional
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from typing import AsyncIterator, List, Optional, Tuple
+from semantic_cache import SemanticCache, cache_key
 
-# Список разрешённых моделей:
+# Разрешённые модели и размер их контекстного окна (в токенах):
 # - одна линейка 3.5
 # - все актуальные модели семейства gpt-4*
-ALLOWED_MODELS = [
-    'gpt-3.5-turbo',
-    'gpt-4',
-    'gpt-4-turbo',
-    'gpt-4-turbo-preview',
-    'gpt-4o',
-    'gpt-4o-2024-05-13',
-    'gpt-4o-2024-08-06',
-    'gpt-4o-mini',
-    'gpt-4o-mini-2024-07-18',
-]
-
-# Инициализация OpenAI клиента
-client = None
-if config.AI_CONFIG['enabled']:
-    try:
-        client = openai.OpenAI(api_key=config.OPENAI_API_KEY)
-    except Exception as e:
-        print(f"[WARNING] OpenAI client not initialized: {e}")
-        client = None
+MODEL_CONTEXT = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4-turbo-preview': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-2024-05-13': 128000,
+    'gpt-4o-2024-08-06': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4o-mini-2024-07-18': 128000,
+}
 
-def validate_model(model_name: str) -> str:
-    """Валидирует и нормализует имя модели"""
-    if not model_name:
-        return 'gpt-3.5-turbo'
-    
-    model = model_name.strip()
-    model_lower = model.lower()
-    
-    # Находим соответствующую модель из списка разрешенных (с учетом регистра)
-    for allowed_model in ALLOWED_MODELS:
-        if model_lower == allowed_model.lower():
-            # Возвращаем оригинальное название из списка (нормализованное)
-            return allowed_model
-    
-    # Если модель не найдена, используем fallback
-    print(f"[WARNING] Model '{model}' is not allowed. Using gpt-3.5-turbo.")
-    return 'gpt-3.5-turbo'
+# Список разрешённых моделей (единый источник - MODEL_CONTEXT)
+ALLOWED_MODELS = list(MODEL_CONTEXT)
 
-def ask_ai(question: str) -> Optional[str]:
-    """
-    Запрашивает ответ у внешнего AI
-    
-    Args:
-        question: Вопрос пользователя
-        
-    Returns:
-        Ответ от AI или None в случае ошибки
-    """
-    if not config.AI_CONFIG['enabled'] or not client:
-        return None
-    
-    try:
-        system_prompt = """Ты — QA-аналитик и тренер мышления в области тестирования и качества ПО.
+# Разрешённые модели по имени в нижнем регистре - для проверки за O(1)
+_ALLOWED_LOWER = {model.lower(): model for model in ALLOWED_MODELS}
+
+# Системные промпты (постоянные, не собираются заново на каждый запрос)
+# Краткий промпт - меньше входных токенов на каждый запрос
+SYSTEM_PROMPT_SHORT = """Ты — QA-ментор в обучающем боте по тестированию ПО для новичков и специалистов уровня middle.
+Отвечай ясно, структурированно, спокойно и без выдуманных фактов.
+Различай факты, интерпретации и допущения; не выдавай допущения за факты.
+Если данных недостаточно — прямо скажи «недостаточно данных» и задай уточняющий вопрос.
+Если вопрос основан на ложном допущении (иллюзия «100% покрытия», вера в полную автоматизацию) — укажи на логическую ошибку.
+Если вопрос не относится к тестированию ПО — вежливо укажи на это."""
+
+# Полный промпт QA-ментора
+SYSTEM_PROMPT_MENTOR = """Ты — QA-аналитик и тренер мышления в области тестирования и качества ПО.
 ТВОЯ ГЛАВНАЯ ЗАДАЧА:
 — не просто отвечать на вопросы,
 — а формировать корректное QA-мышление,
@@ -148,72 +132,592 @@ def ask_ai(question: str) -> Optional[str]:
 • лучше понимает, что и зачем проверять;
 • меньше полагается на ложную уверенность;
 • начинает формулировать более точные вопросы."""
-        
-        # Получаем и валидируем модель из конфига
-        model = validate_model(config.OPENAI_MODEL)
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": question}
-            ],
-            max_tokens=config.AI_CONFIG['max_tokens'],
-            temperature=config.AI_CONFIG['temperature']
+
+# Промпты по режиму AI_CONFIG['prompt_mode']
+PROMPTS = {
+    'short': SYSTEM_PROMPT_SHORT,
+    'mentor': SYSTEM_PROMPT_MENTOR,
+}
+
+# Шаблон запроса проверки релевантности: {0} - вопрос пользователя, {1} - найденный вопрос
+RELEVANCE_PROMPT_TEMPLATE = """Ты эксперт по тестированию ПО. Оцени, релевантен ли найденный ответ вопросу пользователя.
+
+Вопрос пользователя: "{0}"
+
+Найденный вопрос в базе знаний: "{1}"
+
+Ответь ровно одним токеном: YES если ответ релевантен и отвечает на вопрос пользователя, NO если не релевантен или не отвечает на вопрос."""
+
+# Шаблон пакетной проверки релевантности: {0} - вопрос пользователя,
+# {1} - пронумерованный список найденных вопросов, {2} - их количество
+RELEVANCE_MANY_PROMPT_TEMPLATE = """Ты эксперт по тестированию ПО. Для каждого найденного вопроса оцени, релевантен ли его ответ вопросу пользователя.
+
+Вопрос пользователя: "{0}"
+
+Найденные вопросы в базе знаний:
+{1}
+
+Ответь ровно {2} строками, по одной на каждый найденный вопрос по порядку: YES если ответ релевантен и отвечает на вопрос пользователя, NO если не релевантен или не отвечает на вопрос. Больше ничего не пиши."""
+
+# Слова для быстрой проверки релевантности по пересечению
+_WORD_RE = re.compile(r'\w+')
+
+# Проверки релевантности: всего, решенных по пересечению слов без запроса к AI
+# и из них признанных релевантными (jaccard_hi) и нерелевантными (jaccard_lo)
+relevance_stats = {'checks': 0, 'llm_avoided': 0, 'lexical_relevant': 0, 'lexical_irrelevant': 0}
+
+# Метки ответа в пакетной проверке
+_RELEVANCE_LABEL_RE = re.compile(r'\b(YES|NO)\b', re.IGNORECASE)
+
+# Метки ответа классификатора релевантности (ASCII - по одному токену в словаре модели)
+RELEVANCE_LABELS = ('YES', 'NO')
+
+# Запас на служебные токены формата чата (роли, разделители сообщений)
+MESSAGE_OVERHEAD_TOKENS = 16
+
+# Асинхронный OpenAI клиент (один на процесс - один пул соединений).
+# Создается при первом обращении к AI: если все ответы находятся в базе знаний,
+# клиент и его соединения не создаются вовсе
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> Optional[openai.AsyncOpenAI]:
+    """
+    Возвращает общий OpenAI клиент, создавая его при первом вызове
+    
+    Returns:
+        Клиент или None, если AI отключен или клиент не удалось создать
+    """
+    global _client
+    if _client is None and config.AI_CONFIG['enabled']:
+        with _client_lock:
+            if _client is None:
+                try:
+                    # Встроенные повторы SDK отключены - повторные попытки выполняем сами
+                    _client = openai.AsyncOpenAI(
+                        api_key=config.OPENAI_API_KEY,
+                        timeout=30,
+                        max_retries=0,
+                        http_client=httpx.AsyncClient(
+                            http2=True,
+                            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+                        )
+                    )
+                except Exception as e:
+                    print(f"[WARNING] OpenAI client not initialized: {e}")
+    return _client
+
+# Ограничение нагрузки на API: не больше max_concurrency одновременных запросов
+# и не больше rpm запросов в минуту - держимся ниже лимита вместо повторов после 429.
+# Семафор и лимитер привязываются к event loop, в котором их ждут: создаются при первом
+# запросе в текущем loop (новый asyncio.run - новые объекты) и заново после reload_config()
+_limits = None
+_limits_loop = None
+
+def _get_limits() -> Tuple[asyncio.Semaphore, AsyncLimiter]:
+    """Возвращает (семафор, лимитер запросов) для текущего event loop"""
+    global _limits, _limits_loop
+    loop = asyncio.get_running_loop()
+    if _limits is None or _limits_loop is not loop:
+        _limits = (
+            asyncio.Semaphore(config.AI_CONFIG['max_concurrency']),
+            AsyncLimiter(config.AI_CONFIG['rpm'], time_period=60)
         )
-        
-        answer = response.choices[0].message.content.strip()
-        return answer
-        
-    except APIError as e:
-        print(f"[ERROR] OpenAI API error: {e}")
+        _limits_loop = loop
+    return _limits
+
+async def _ping():
+    """Дешевый запрос к API, который держит соединение открытым"""
+    await get_client().with_options(timeout=5).models.list()
+
+async def warm_up():
+    """
+    Открывает соединение с OpenAI API заранее и поддерживает его
+    
+    Первый запрос пользователя не тратит время на TCP и TLS рукопожатие.
+    Далее API опрашивается раз в keepalive_interval секунд, чтобы
+    простаивающее соединение не закрыли NAT или прокси.
+    """
+    try:
+        await _ping()
+        print("[INFO] OpenAI connection warmed up")
+    except Exception as e:
+        print(f"[WARNING] OpenAI warm-up failed: {e}")
+    
+    interval = config.AI_CONFIG['keepalive_interval']
+    while interval:
+        await asyncio.sleep(interval)
+        try:
+            await _ping()
+        except Exception as e:
+            print(f"[WARNING] OpenAI keep-alive failed: {e}")
+
+def start_warm_up():
+    """
+    Запускает warm_up задачей в текущем event loop, не дожидаясь результата
+    
+    Вызывается из loop бота: соединения AsyncOpenAI привязаны к loop, в котором открыты.
+    """
+    if not config.AI_CONFIG['enabled'] or get_client() is None:
         return None
+    return asyncio.create_task(warm_up())
+
+# Запросы к модели, выполняющиеся сейчас: ключ вопроса -> future с итоговым ответом
+_inflight = {}
+
+# Кэш ответов AI: точное совпадение вопроса или близкий по смыслу вопрос
+response_cache = SemanticCache(
+    threshold=config.AI_CONFIG['semantic_cache_threshold'],
+    ttl=config.AI_CONFIG['semantic_cache_ttl'],
+    max_size=config.AI_CONFIG['semantic_cache_max_size'],
+    path=config.AI_CONFIG['semantic_cache_path']
+)
+
+# Задача фонового сохранения кэша (ссылка держится, пока запись не завершится)
+_cache_save_task = None
+
+def _schedule_cache_save():
+    """Сохраняет семантический кэш в фоне, если предыдущее сохранение уже завершилось"""
+    global _cache_save_task
+    if _cache_save_task is None or _cache_save_task.done():
+        _cache_save_task = asyncio.create_task(response_cache.save_async())
+
+# Повтор при временных ошибках: экспоненциальная задержка с jitter
+_retry_transient = retry(
+    wait=wait_random_exponential(min=config.AI_CONFIG['base_delay'], max=60),
+    stop=stop_after_attempt(config.AI_CONFIG['max_retries']),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)),
+    reraise=True
+)
+
+@_retry_transient
+async def _create(**kwargs):
+    """Запрос к chat.completions с экспоненциальной задержкой и jitter при временных ошибках"""
+    semaphore, rate_limiter = _get_limits()
+    async with semaphore, rate_limiter:
+        return await get_client().chat.completions.create(**kwargs)
+
+@_retry_transient
+async def _open_stream(**kwargs):
+    """Открывает потоковый запрос к chat.completions (повторы - как у _create, без семафора)"""
+    _, rate_limiter = _get_limits()
+    async with rate_limiter:
+        return await get_client().chat.completions.create(stream=True, **kwargs)
+
+@contextlib.asynccontextmanager
+async def _create_stream(**kwargs):
+    """
+    Потоковый запрос к chat.completions с ограничением одновременных запросов
+    
+    create() возвращает поток до того, как ответ сгенерирован: слот семафора
+    занят, пока поток не прочитан до конца (выход из async with), иначе
+    max_concurrency не ограничивал бы потоковые ответы.
+    """
+    semaphore, _ = _get_limits()
+    async with semaphore:
+        async with await _open_stream(**kwargs) as stream:
+            yield stream
+
+@_retry_transient
+async def _create_embedding(text: str):
+    """Запрос эмбеддинга с той же политикой повторов"""
+    return await get_client().embeddings.create(model=config.AI_CONFIG['embedding_model'], input=text)
+
+async def _embed(text: str):
+    """Возвращает эмбеддинг текста или None, если получить его не удалось"""
+    try:
+        response = await _create_embedding(text)
+        return response.data[0].embedding
     except Exception as e:
-        print(f"[ERROR] Error requesting AI: {e}")
+        print(f"[WARNING] Error getting embedding: {e}")
         return None
 
-def check_relevance(user_question: str, found_question: str, found_answer: str) -> Optional[bool]:
+# Кодировщики tiktoken по модели (None - словарь недоступен)
+_encodings = {}
+
+def _encoding_for(model: str):
     """
-    Проверяет через AI, релевантен ли найденный ответ вопросу пользователя
+    Возвращает кодировщик tiktoken для модели или None
+    
+    Словарь загружается один раз на модель; первая загрузка идет по сети,
+    поэтому из асинхронного кода используйте _load_encoding.
+    """
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            print(f"[WARNING] Tokenizer for {model} not available: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+async def _load_encoding(model: str):
+    """Загружает кодировщик в отдельном потоке, не блокируя цикл событий"""
+    if model in _encodings:
+        return _encodings[model]
+    return await asyncio.to_thread(_encoding_for, model)
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Считает токены текста для модели
+    
+    Если словарь модели недоступен, возвращает длину текста в символах
+    (оценка сверху для обычного текста).
+    """
+    encoding = _encoding_for(model or _MODEL)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+# Число токенов системных промптов по (модели, режиму) - промпты постоянные
+_prompt_tokens = {}
+
+def _system_prompt_tokens(model: str, prompt_mode: str, prompt: str) -> int:
+    key = (model, prompt_mode)
+    if key not in _prompt_tokens:
+        _prompt_tokens[key] = count_tokens(prompt, model)
+    return _prompt_tokens[key]
+
+def _fit_question(question: str, model: str, prompt_mode: str, prompt: str) -> Optional[str]:
+    """
+    Укладывает запрос в контекстное окно модели до отправки
     
-    Args:
-        user_question: Вопрос пользователя
-        found_question: Найденный вопрос в базе
-        found_answer: Найденный ответ в базе
-        
     Returns:
-        True если релевантен, False если нет, None если AI недоступен или произошла ошибка
+        Вопрос целиком; его конец, если вопрос не помещается (начало отбрасывается);
+        None, если места под вопрос не остается совсем
     """
-    if not config.AI_CONFIG['enabled'] or not client:
-        # Если AI не доступен, возвращаем None - это сигнал использовать AI fallback
+    budget = (MODEL_CONTEXT[model]
+              - _system_prompt_tokens(model, prompt_mode, prompt)
+              - _MAX_TOKENS
+              - MESSAGE_OVERHEAD_TOKENS)
+    if budget <= 0:
+        print(f"[WARNING] No context left for the question: model {model}, prompt '{prompt_mode}'")
         return None
+    encoding = _encoding_for(model)
+    if encoding is None:
+        if len(question) <= budget:
+            return question
+        print(f"[WARNING] Question truncated from {len(question)} to {budget} characters")
+        return question[-budget:]
+    tokens = encoding.encode(question)
+    if len(tokens) <= budget:
+        return question
+    print(f"[WARNING] Question truncated from {len(tokens)} to {budget} tokens")
+    return encoding.decode(tokens[-budget:])
+
+# logit_bias для меток релевантности по модели (вычисляется один раз на модель)
+_label_bias_by_model = {}
+
+async def _relevance_label_bias(model: str) -> Optional[dict]:
+    """
+    Возвращает logit_bias, ограничивающий ответ модели метками YES/NO
     
-    if not config.SEARCH_CONFIG.get('use_ai_relevance_check', False):
-        # Если проверка отключена, возвращаем None - пусть основная логика решает
-        # Это позволит использовать AI fallback для средних score
+    Если словарь модели недоступен или метка не кодируется одним токеном,
+    возвращает None - запрос уходит без logit_bias.
+    """
+    if model not in _label_bias_by_model:
+        encoding = await _load_encoding(model)
+        _label_bias_by_model[model] = _build_label_bias(encoding) if encoding is not None else None
+    return _label_bias_by_model[model]
+
+def _build_label_bias(encoding) -> Optional[dict]:
+    token_ids = [encoding.encode(label) for label in RELEVANCE_LABELS]
+    if any(len(ids) != 1 for ids in token_ids):
         return None
+    return {str(ids[0]): 100 for ids in token_ids}
+
+# Статистика запросов к моделям: модель -> счетчики запросов и токенов
+model_stats = {}
+
+def pick_model(question: str) -> str:
+    """
+    Выбирает модель для ответа на вопрос
+    
+    Короткие вопросы без блоков кода отправляются малой модели, остальные - большой.
+    Если автовыбор отключен, используется OPENAI_MODEL.
+    """
+    if not _AUTO_ROUTER:
+        return _MODEL
+    if len(question) < _ROUTER_SHORT_LENGTH and '```' not in question:
+        return _SMALL_MODEL
+    return _LARGE_MODEL
+
+def _record_usage(model: str, usage=None):
+    """Учитывает запрос к модели; usage - расход токенов из последнего фрагмента ответа"""
+    stats = model_stats.setdefault(model, {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0})
+    if usage is None:
+        stats['requests'] += 1
+        return
+    # Токены системного промпта, взятые из кэша промптов OpenAI
+    details = usage.prompt_tokens_details
+    cached_tokens = (details.cached_tokens or 0) if details else 0
+    stats['prompt_tokens'] += usage.prompt_tokens
+    stats['cached_tokens'] += cached_tokens
+    stats['completion_tokens'] += usage.completion_tokens
+    print(f"[INFO] {model}: {usage.prompt_tokens} prompt tokens ({cached_tokens} cached), {usage.completion_tokens} completion tokens")
+
+def get_model_stats() -> dict:
+    """Возвращает число запросов и средний расход токенов по моделям"""
+    return {
+        model: {
+            'requests': stats['requests'],
+            'avg_prompt_tokens': stats['prompt_tokens'] / stats['requests'] if stats['requests'] else 0,
+            'avg_cached_tokens': stats['cached_tokens'] / stats['requests'] if stats['requests'] else 0,
+            'avg_completion_tokens': stats['completion_tokens'] / stats['requests'] if stats['requests'] else 0,
+        }
+        for model, stats in model_stats.items()
+    }
+
+def log_stats():
+    """Выводит в лог накопленную статистику запросов к моделям и проверок релевантности (например, при остановке бота)"""
+    for model, stats in get_model_stats().items():
+        print(
+            f"[INFO] {model}: {stats['requests']} requests, avg {stats['avg_prompt_tokens']:.0f} prompt tokens "
+            f"({stats['avg_cached_tokens']:.0f} cached), avg {stats['avg_completion_tokens']:.0f} completion tokens"
+        )
+    stats = get_relevance_stats()
+    if stats['checks']:
+        # По этим числам подбираются пороги jaccard_hi и jaccard_lo в SEARCH_CONFIG
+        print(
+            f"[INFO] Relevance checks: {stats['checks']}, decided by word overlap: {stats['llm_avoided']} "
+            f"({stats['llm_avoided_rate']:.0%}; relevant {stats['lexical_relevant']}, "
+            f"irrelevant {stats['lexical_irrelevant']}), sent to AI: {stats['checks'] - stats['llm_avoided']}"
+        )
+
+def validate_model(model_name: str) -> str:
+    """Валидирует и нормализует имя модели"""
+    if not model_name:
+        return 'gpt-3.5-turbo'
     
+    model = model_name.strip()
+    
+    # Возвращаем оригинальное название из списка разрешенных (без учета регистра)
+    allowed_model = _ALLOWED_LOWER.get(model.lower())
+    if allowed_model:
+        return allowed_model
+    
+    # Если модель не найдена, используем fallback
+    print(f"[WARNING] Model '{model}' is not allowed. Using gpt-3.5-turbo.")
+    return 'gpt-3.5-turbo'
+
+# Снимок настроек, которые читаются на каждом запросе (конфиг не меняется во время работы).
+# После изменения config (например, в тестах) вызовите reload_config()
+def reload_config():
+    """Перечитывает настройки AI из config"""
+    global _AI_ENABLED, _USE_CACHE, _USE_RELEVANCE, _MODEL, _MAX_TOKENS, _TEMPERATURE
+    global _PROMPT_MODE, _SYSTEM_PROMPT, _AUTO_ROUTER, _ROUTER_SHORT_LENGTH, _SMALL_MODEL, _LARGE_MODEL
+    global _SPECULATIVE, _JACCARD_HI, _JACCARD_LO, _limits
+    ai_config = config.AI_CONFIG
+    # Новые max_concurrency и rpm применяются к следующим запросам
+    _limits = None
+    _AI_ENABLED = ai_config['enabled']
+    _USE_CACHE = ai_config['semantic_cache']
+    _USE_RELEVANCE = config.SEARCH_CONFIG.get('use_ai_relevance_check', False)
+    _MODEL = validate_model(config.OPENAI_MODEL)
+    _MAX_TOKENS = ai_config['max_tokens']
+    _TEMPERATURE = ai_config['temperature']
+    _PROMPT_MODE = ai_config['prompt_mode']
+    _SYSTEM_PROMPT = PROMPTS.get(_PROMPT_MODE, SYSTEM_PROMPT_MENTOR)
+    _AUTO_ROUTER = ai_config.get('auto_router', False)
+    _ROUTER_SHORT_LENGTH = ai_config['router_short_length']
+    _SMALL_MODEL = validate_model(ai_config['router_small_model'])
+    _LARGE_MODEL = validate_model(ai_config['router_large_model'])
+    _SPECULATIVE = ai_config.get('speculative', False)
+    _JACCARD_HI = config.SEARCH_CONFIG['jaccard_hi']
+    _JACCARD_LO = config.SEARCH_CONFIG['jaccard_lo']
+
+reload_config()
+
+def _strip(text: str) -> str:
+    """Убирает пробелы по краям, не копируя строку, если их нет (обычный случай для ответов API)"""
+    if text and (text[0].isspace() or text[-1].isspace()):
+        return text.strip()
+    return text
+
+async def ask_ai_stream(question: str) -> AsyncIterator[str]:
+    """
+    Запрашивает ответ у внешнего AI и отдает его по частям по мере генерации
+    
+    Одинаковые вопросы, заданные одновременно, объединяются в один запрос:
+    повторный вызов ждет ответ первого и получает его одним фрагментом.
+    
+    Args:
+        question: Вопрос пользователя
+        
+    Yields:
+        Фрагменты ответа; ответ из кэша отдается одним фрагментом.
+        Ошибки API пробрасываются вызывающему коду.
+    """
+    if not _AI_ENABLED or get_client() is None:
+        return
+    
+    # Модель выбирается по сложности вопроса еще до кэша: ответы другого режима промпта
+    # или другой модели из кэша не отдаются
+    model = pick_model(question)
+    prompt_mode = _PROMPT_MODE
+    scope = f"{prompt_mode}:{model}"
+    
+    use_cache = _USE_CACHE
+    if use_cache:
+        # Дословно такой же вопрос - отвечаем без запросов к API
+        cached = response_cache.get_exact(question, scope)
+        if cached is not None:
+            yield cached
+            return
+    
+    key = cache_key(question, scope)
+    pending = _inflight.get(key)
+    if pending is not None:
+        # Такой же вопрос уже обрабатывается - ждем его ответ вместо нового запроса
+        answer = await asyncio.shield(pending)
+        if answer:
+            yield answer
+        return
+    
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    parts = []
+    completed = False
     try:
-        # Получаем и валидируем модель
-        model = validate_model(config.OPENAI_MODEL)
+        async for delta in _generate_answer(question, model, prompt_mode, scope, use_cache):
+            parts.append(delta)
+            yield delta
+        completed = True
+    finally:
+        _inflight.pop(key, None)
+        # Ожидающим вызовам при ошибке отдаем None - ошибку получает только первый
+        future.set_result(_strip("".join(parts)) if completed else None)
+
+async def _generate_answer(question: str, model: str, prompt_mode: str, scope: str,
+                           use_cache: bool) -> AsyncIterator[str]:
+    """Отвечает из семантического кэша области scope или запросом к модели; новый ответ кладет в кэш"""
+    embedding = None
+    if use_cache:
+        # Похожий по смыслу вопрос - отвечаем без запроса к модели
+        embedding = await _embed(question)
+        if embedding is not None:
+            cached = response_cache.get_similar(embedding, scope)
+            if cached is not None:
+                yield cached
+                return
+    
+    system_prompt = PROMPTS.get(prompt_mode, SYSTEM_PROMPT_MENTOR)
+    
+    # Проверяем размер запроса локально, до сетевого вызова
+    await _load_encoding(model)
+    prompt_question = _fit_question(question, model, prompt_mode, system_prompt)
+    if prompt_question is None:
+        return
+    
+    # Системный промпт неизменен и всегда идет первым, все переменное - в сообщении
+    # пользователя: так префикс запроса попадает в кэш промптов OpenAI.
+    # prompt_cache_key направляет запросы с одним промптом на один узел кэша
+    # (через extra_body: именованный параметр есть только в новых версиях SDK)
+    parts = []
+    async with _create_stream(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_question}
+        ],
+        extra_body={"prompt_cache_key": f"qa-mentor-{prompt_mode}"},
+        max_tokens=_MAX_TOKENS,
+        temperature=_TEMPERATURE,
+        stream_options={"include_usage": True}
+    ) as stream:
+        _record_usage(model)
+        async for chunk in stream:
+            if not chunk.choices:
+                # Последний фрагмент без choices содержит расход токенов
+                if chunk.usage is not None:
+                    _record_usage(model, chunk.usage)
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    
+    answer = _strip("".join(parts))
+    if use_cache and answer:
+        response_cache.put(question, answer, embedding, scope)
+        if response_cache.save_due():
+            _schedule_cache_save()
+
+async def ask_ai(question: str) -> Optional[str]:
+    """
+    Запрашивает ответ у внешнего AI
+    
+    Args:
+        question: Вопрос пользователя
         
-        prompt = f"""Ты эксперт по тестированию ПО. Оцени, релевантен ли найденный ответ вопросу пользователя.
+    Returns:
+        Ответ от AI или None в случае ошибки
+    """
+    try:
+        answer = _strip("".join([delta async for delta in ask_ai_stream(question)]))
+        return answer or None
+        
+    except APIError as e:
+        print(f"[ERROR] OpenAI API error: {e}")
+        return None
+    except Exception as e:
+        print(f"[ERROR] Error requesting AI: {e}")
+        return None
 
-Вопрос пользователя: "{user_question}"
+def _words(text: str) -> set:
+    return set(_WORD_RE.findall(text.lower()))
 
-Найденный вопрос в базе знаний: "{found_question}"
+def _lexical_relevance(user_question: str, found_question: str) -> Optional[bool]:
+    """
+    Быстрая проверка релевантности по пересечению слов (коэффициент Жаккара)
+    
+    Returns:
+        True при большом пересечении, False при очень малом,
+        None - неочевидный случай, решает AI
+    """
+    user_words = _words(user_question)
+    found_words = _words(found_question)
+    jaccard = len(user_words & found_words) / max(1, len(user_words | found_words))
+    relevance_stats['checks'] += 1
+    if jaccard >= _JACCARD_HI:
+        verdict = True
+        relevance_stats['lexical_relevant'] += 1
+    elif jaccard < _JACCARD_LO:
+        verdict = False
+        relevance_stats['lexical_irrelevant'] += 1
+    else:
+        return None
+    relevance_stats['llm_avoided'] += 1
+    return verdict
 
-Ответь ТОЛЬКО одним словом: "ДА" если ответ релевантен и отвечает на вопрос пользователя, "НЕТ" если не релевантен или не отвечает на вопрос."""
+def get_relevance_stats() -> dict:
+    """Возвращает число проверок релевантности и долю решенных без запроса к AI"""
+    checks = relevance_stats['checks']
+    return {**relevance_stats, 'llm_avoided_rate': relevance_stats['llm_avoided'] / checks if checks else 0}
+
+async def _classify_relevance(user_question: str, found_question: str) -> Optional[bool]:
+    """Запрос к модели-классификатору релевантности для одной пары"""
+    try:
+        # Модель проверена при загрузке настроек (reload_config)
+        model = _MODEL
+        
+        prompt = RELEVANCE_PROMPT_TEMPLATE.format(user_question, found_question)
         
-        response = client.chat.completions.create(
+        # Ответ ровно одним токеном; logit_bias ограничивает выбор метками YES/NO
+        request = {}
+        label_bias = await _relevance_label_bias(model)
+        if label_bias:
+            request['logit_bias'] = label_bias
+        
+        response = await _create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
-            max_tokens=10,
-            temperature=0.1
+            max_tokens=1,
+            temperature=0,
+            **request
         )
         
-        answer = response.choices[0].message.content.strip().upper()
-        is_relevant = "ДА" in answer or "YES" in answer or "TRUE" in answer
+        answer = response.choices[0].message.content or ""
+        is_relevant = answer.startswith(('Y', 'y'))
         
         if not is_relevant:
             print(f"[INFO] AI determined that answer is not relevant for question: '{user_question}'")
@@ -224,3 +728,85 @@ def check_relevance(user_question: str, found_question: str, found_answer: str)
         print(f"[WARNING] Error checking relevance via AI: {e}")
         # В случае ошибки возвращаем None - это сигнал использовать AI fallback
         return None
+
+async def check_relevance_many(user_question: str, pairs: List[Tuple[str, str]]) -> List[Optional[bool]]:
+    """
+    Проверяет релевантность нескольких найденных ответов одним запросом к AI
+    
+    Очевидные случаи решаются по пересечению слов; к AI уходят только остальные пары.
+    
+    Args:
+        user_question: Вопрос пользователя
+        pairs: Список пар (найденный вопрос, найденный ответ)
+        
+    Returns:
+        Список результатов в порядке pairs: True если ответ релевантен, False если нет,
+        None если AI недоступен или произошла ошибка (сигнал использовать AI fallback).
+        Если модель вернула не столько меток, сколько пар, пары проверяются по отдельности.
+    """
+    if not _AI_ENABLED or get_client() is None:
+        return [None] * len(pairs)
+    
+    if not _USE_RELEVANCE:
+        return [None] * len(pairs)
+    
+    results = [_lexical_relevance(user_question, question) for question, _ in pairs]
+    pending = [i for i, verdict in enumerate(results) if verdict is None]
+    if len(pending) == 1:
+        results[pending[0]] = await _classify_relevance(user_question, pairs[pending[0]][0])
+    elif pending:
+        for i, verdict in zip(pending, await _classify_relevance_many(user_question, [pairs[i][0] for i in pending])):
+            results[i] = verdict
+    return results
+
+async def _classify_relevance_many(user_question: str, found_questions: List[str]) -> List[Optional[bool]]:
+    """Один запрос к модели-классификатору для нескольких найденных вопросов"""
+    try:
+        model = _MODEL
+        
+        numbered = "\n".join(
+            f'{number}) "{question}"' for number, question in enumerate(found_questions, 1)
+        )
+        prompt = RELEVANCE_MANY_PROMPT_TEMPLATE.format(user_question, numbered, len(found_questions))
+        
+        # По метке и переводу строки на пару плюс небольшой запас
+        response = await _create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=2 * len(found_questions) + 5,
+            temperature=0
+        )
+        
+        labels = _RELEVANCE_LABEL_RE.findall(response.choices[0].message.content or "")
+        
+    except Exception as e:
+        print(f"[WARNING] Error checking relevance via AI: {e}")
+        return [None] * len(found_questions)
+    
+    if len(labels) != len(found_questions):
+        print(f"[WARNING] Batch relevance check returned {len(labels)} labels for {len(found_questions)} answers, checking one by one")
+        return list(await asyncio.gather(
+            *[_classify_relevance(user_question, question) for question in found_questions]
+        ))
+    
+    results = [label[0] in 'Yy' for label in labels]
+    for question, is_relevant in zip(found_questions, results):
+        if not is_relevant:
+            print(f"[INFO] AI determined that answer '{question}' is not relevant for question: '{user_question}'")
+    return results
+
+def start_speculative_answer(question: str):
+    """
+    Заранее запускает запрос ответа AI, пока идет проверка релевантности
+    
+    Если ответ из базы окажется нерелевантным, fallback присоединится к уже
+    идущему запросу (одинаковые вопросы объединяются), и задержки проверки
+    и ответа не складываются. Если ответ из базы подошел, вызовите cancel()
+    у возвращенной задачи - прерванный запрос все равно тратит часть токенов.
+    
+    Returns:
+        asyncio.Task в текущем event loop или None, если режим отключен в конфиге
+    """
+    if not _SPECULATIVE or not _AI_ENABLED or get_client() is None:
+        return None
+    return asyncio.create_task(ask_ai(question))
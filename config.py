@@ -2,18 +2,39 @@
 Конфигурационный файл для Telegram-бота QA Ментор
 Использует переменные окружения для безопасного хранения токена
 """
+import functools
 import os
 from dotenv import load_dotenv
 
-# Загружаем переменные окружения из .env файла
-load_dotenv()
+# Настройки из окружения (BOT_TOKEN, OPENAI_API_KEY, OPENAI_MODEL, AI_CONFIG) читаются
+# лениво - при первом обращении к config.<имя>, и один раз: .env загружается однократно
 
-# Токен бота из переменных окружения
-BOT_TOKEN = os.getenv('BOT_TOKEN', '')
+@functools.cache
+def get_env():
+    """Загружает переменные окружения из .env файла (один раз) и возвращает окружение"""
+    load_dotenv()
+    return os.environ
 
-# OpenAI API ключ (опционально - для fallback к AI)
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
-OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')  # или 'gpt-4'
+@functools.cache
+def bot_token():
+    """Токен бота из переменных окружения"""
+    token = get_env().get('BOT_TOKEN', '')
+    # Проверка наличия токена
+    if not token:
+        raise ValueError(
+            "BOT_TOKEN не найден! Создайте файл .env и добавьте в него BOT_TOKEN=ваш_токен_бота"
+        )
+    return token
+
+@functools.cache
+def openai_api_key():
+    """OpenAI API ключ (опционально - для fallback к AI)"""
+    return get_env().get('OPENAI_API_KEY', '')
+
+@functools.cache
+def openai_model():
+    """Модель OpenAI"""
+    return get_env().get('OPENAI_MODEL', 'gpt-3.5-turbo')  # или 'gpt-4'
 
 # Название бота (централизованное - измени здесь, и оно обновится везде)
 BOT_NAME = "QA Ментор"
@@ -24,7 +45,11 @@ SEARCH_CONFIG = {
     'high_relevance_score': 8.0,  # Высокий порог - показывать только этот результат
     'max_results': 3,  # Максимальное количество результатов поиска
     'use_synonyms': True,  # Использовать синонимы при поиске
+    'use_fuzzy': True,  # Учитывать опечатки: слова базы знаний на расстоянии 1 правки (2 - для слов от 6 букв)
+    'fuzzy_min_length': 4,  # Минимальная длина слова для поиска с опечатками
     'use_ai_relevance_check': True,  # Использовать AI для проверки релевантности найденных ответов
+    'jaccard_hi': 0.6,  # Доля общих слов вопроса и найденного вопроса, при которой ответ релевантен без проверки AI
+    'jaccard_lo': 0.0,  # Доля общих слов, ниже которой ответ нерелевантен без проверки AI. 0 отключает отклонение без AI: поиск находит вопросы по синонимам и опечаткам, у которых может не быть ни одного общего слова с запросом, поэтому малое пересечение слов не доказывает нерелевантность (статистика - в логе при остановке бота)
 }
 
 # Параметры форматирования ответов
@@ -32,6 +57,21 @@ FORMATTING_CONFIG = {
     'max_message_length': 4096,  # Максимальная длина сообщения Telegram
     'use_markdown': True,  # Использовать Markdown форматирование
     'default_detail_level': 'detailed',  # Уровень детализации по умолчанию: 'brief', 'detailed', 'full'
+    'stream_update_chars': 80,  # Обновлять черновик ответа AI не чаще, чем каждые N новых символов
+    'stream_update_interval': 1.0,  # ...и не чаще, чем раз в N секунд (лимит Telegram на редактирование)
+}
+
+# Настройки сессий пользователей
+SESSION_CONFIG = {
+    'max_sessions': 50000,  # Максимальное число сессий в памяти (лишние вытесняются, начиная с давно неактивных)
+    'session_ttl': 24 * 3600,  # Сессия удаляется после N секунд неактивности
+}
+
+# Настройки соединения с Telegram API
+TELEGRAM_CONFIG = {
+    'connection_limit': 100,  # Максимальное число одновременных соединений в общем пуле aiohttp
+    'request_timeout': 30,  # Таймаут запроса к API в секундах (по умолчанию в библиотеке - 300)
+    'polling_timeout': 20,  # Время ожидания новых сообщений в одном запросе getUpdates (long polling)
 }
 
 # Настройки безопасности
@@ -44,16 +84,44 @@ SECURITY_CONFIG = {
 }
 
 # Настройки для AI fallback
-AI_CONFIG = {
-    'enabled': bool(OPENAI_API_KEY),  # Включен только если есть ключ
-    'use_fallback': True,  # Использовать AI если не найдено в базе
-    'max_tokens': 500,  # Максимальная длина ответа
-    'temperature': 0.7,  # Креативность ответов
-}
+@functools.cache
+def ai_config():
+    """Настройки AI; max_tokens и temperature можно переопределить через AI_MAX_TOKENS и AI_TEMPERATURE"""
+    env = get_env()
+    return {
+        'enabled': bool(openai_api_key()),  # Включен только если есть ключ
+        'use_fallback': True,  # Использовать AI если не найдено в базе
+        'max_tokens': int(env.get('AI_MAX_TOKENS', '500')),  # Максимальная длина ответа
+        'temperature': float(env.get('AI_TEMPERATURE', '0.7')),  # Креативность ответов
+        'prompt_mode': 'mentor',  # Системный промпт: 'mentor' (полный) или 'short' (краткий, дешевле по токенам)
+        'max_retries': 6,  # Максимальное число попыток запроса при временных ошибках (429, таймаут, сеть)
+        'base_delay': 1.0,  # Минимальная задержка между попытками в секундах (растет экспоненциально до 60)
+        'max_concurrency': 8,  # Максимальное число одновременных запросов к OpenAI
+        'rpm': 500,  # Максимальное число запросов к OpenAI в минуту (держать ниже лимита аккаунта)
+        'semantic_cache': True,  # Кэшировать ответы AI и отдавать их на повторные и близкие по смыслу вопросы
+        'semantic_cache_threshold': 0.92,  # Минимальная косинусная близость вопросов для попадания в кэш
+        'semantic_cache_ttl': 7 * 24 * 3600,  # Время жизни записи в кэше (секунды)
+        'semantic_cache_max_size': 1000,  # Максимальное количество записей (вытесняются давно неиспользуемые)
+        'semantic_cache_path': 'semantic_cache.json',  # Файл для сохранения кэша между перезапусками (эмбеддинги - в .npy рядом)
+        'embedding_model': 'text-embedding-3-small',  # Модель эмбеддингов для семантического кэша
+        'auto_router': False,  # Выбирать модель по вопросу: короткие - малой модели, длинные и с кодом - большой (при включении OPENAI_MODEL для ответов не используется)
+        'router_short_length': 200,  # Вопрос короче N символов и без блоков кода считается простым
+        'router_small_model': 'gpt-4o-mini',  # Модель для простых вопросов
+        'router_large_model': 'gpt-4o',  # Модель для длинных и сложных вопросов
+        'speculative': False,  # Запрашивать ответ AI параллельно с проверкой релевантности (быстрее fallback, но тратит токены, если ответ из базы подошел)
+        'keepalive_interval': 240,  # Пинговать OpenAI API раз в N секунд, чтобы соединение не простаивало (0 - только прогрев при запуске)
+    }
 
-# Проверка наличия токена
-if not BOT_TOKEN:
-    raise ValueError(
-        "BOT_TOKEN не найден! Создайте файл .env и добавьте в него BOT_TOKEN=ваш_токен_бота"
-    )
+# Ленивый доступ к настройкам из окружения как к атрибутам модуля: config.AI_CONFIG и т.д.
+_LAZY_SETTINGS = {
+    'BOT_TOKEN': bot_token,
+    'OPENAI_API_KEY': openai_api_key,
+    'OPENAI_MODEL': openai_model,
+    'AI_CONFIG': ai_config,
+}
 
+def __getattr__(name):
+    getter = _LAZY_SETTINGS.get(name)
+    if getter is None:
+        raise AttributeError(f"module 'config' has no attribute '{name}'")
+    return getter()
@@ -1,164 +1,604 @@
-import telebot
-from telebot import types
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+import asyncio
 import config
+import functools
+import heapq
 import re
+import time
+from collections import namedtuple
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Optional
+from cachetools import TTLCache
 from knowledge_base import TOPICS, TOPIC_ORDER, SYNONYMS
 import security
 import ai_helper
+from trie import Trie
 
-# Инициализация бота
-bot = telebot.TeleBot(config.BOT_TOKEN)
+# Инициализация бота: асинхронные обработчики выполняются в одном event loop,
+# и пока один пользователь ждет ответа Telegram или AI, обрабатываются сообщения остальных
+bot = AsyncTeleBot(config.BOT_TOKEN)
 
-# Словарь для хранения состояния пользователей
-# Формат: {user_id: {"current_topic": "start", "current_question_index": 0}}
-user_sessions = {}
+# Все запросы к Telegram идут через одну сессию aiohttp с пулом соединений:
+# размер пула - на пиковое число одновременных ответов, таймаут - чтобы зависший
+# запрос не держал обработчик 5 минут (значение по умолчанию в библиотеке)
+asyncio_helper.REQUEST_LIMIT = config.TELEGRAM_CONFIG['connection_limit']
+asyncio_helper.REQUEST_TIMEOUT = config.TELEGRAM_CONFIG['request_timeout']
 
+# Позиции тем в порядке обучения: навигация без линейного поиска TOPIC_ORDER.index
+_TOPIC_POS = {topic_key: i for i, topic_key in enumerate(TOPIC_ORDER)}
+_LAST_TOPIC = TOPIC_ORDER[-1]
+_NUM_TOPICS = len(TOPIC_ORDER)
+
+@dataclass(slots=True)
+class Session:
+    """Состояние пользователя (__slots__ вместо словаря - меньше памяти на каждого пользователя)"""
+    current_topic: str = "start"
+    current_question_index: int = 0
+    previous_state: Optional[object] = None  # Для кнопки "Назад"
+
+# Состояние пользователей: ограниченный по размеру кэш, неактивные сессии удаляются по TTL
+# Формат: {user_id: Session}
+user_sessions = TTLCache(
+    maxsize=config.SESSION_CONFIG['max_sessions'],
+    ttl=config.SESSION_CONFIG['session_ttl']
+)
 def get_user_session(user_id):
     """Получаем или создаем сессию для пользователя"""
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {
-            "current_topic": "start",
-            "current_question_index": 0,
-            "previous_state": None  # Для кнопки "Назад"
-        }
-    return user_sessions[user_id]
+    # Без await внутри - в event loop выполняется целиком, блокировка не нужна
+    session = user_sessions.get(user_id)
+    if session is None:
+        session = Session()
+    # Повторная запись продлевает TTL - удаляются только неактивные сессии
+    user_sessions[user_id] = session
+    return session
+
+# Шаблон знаков препинания (компилируется один раз)
+_PUNCT_RE = re.compile(r'[^\w\s]')
 
 def normalize_text(text):
     """Нормализация текста для поиска: приведение к нижнему регистру, удаление знаков препинания"""
-    text = text.lower()
-    # Удаляем знаки препинания, оставляем только буквы, цифры и пробелы
-    text = re.sub(r'[^\w\s]', ' ', text)
-    # Удаляем множественные пробелы
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    # casefold - сравнение без учета регистра для всех алфавитов (lower не сводит, например, ß к ss);
+    # удаляем знаки препинания (оставляем только буквы, цифры и пробелы);
+    # split/join убирает множественные пробелы и пробелы по краям без второго regex
+    return ' '.join(_PUNCT_RE.sub(' ', text.casefold()).split())
+
+# Текст, которым заканчивается обрезанное сообщение
+TRUNCATE_TEXT = "\n\n... (сообщение обрезано)"
+# На сколько символов от места обрезки можно отступить назад, чтобы не резать слово
+TRUNCATE_WORD_LOOKBACK = 200
+
+def _close_markdown(text):
+    """
+    Закрывает сущность Markdown (*, _, `, ```), оставшуюся открытой в конце text
+    
+    Сущности в Markdown Telegram не вкладываются, поэтому достаточно одного прохода
+    с запоминанием открытой сущности; символ после \\ не считается разметкой.
+    """
+    open_entity = None
+    i = 0
+    length = len(text)
+    while i < length:
+        if text[i] == '\\' and open_entity is None:
+            i += 2
+            continue
+        if open_entity is not None:
+            if text.startswith(open_entity, i):
+                i += len(open_entity)
+                open_entity = None
+            else:
+                i += 1
+            continue
+        if text.startswith('```', i):
+            open_entity = '```'
+            i += 3
+            continue
+        if text[i] in '*_`':
+            open_entity = text[i]
+        i += 1
+    if open_entity == '```':
+        return text + '\n```'
+    return text + open_entity if open_entity else text
+
+def _truncate_message(text, limit=4000, markdown=True):
+    """
+    Обрезает сообщение так, чтобы вместе с текстом обрезки оно было не длиннее limit
+    
+    Длина считается в единицах UTF-16, как ее считает Telegram (эмодзи - 2 единицы);
+    limit по умолчанию оставляет запас до лимита FORMATTING_CONFIG['max_message_length'].
+    Текст обрезается по границе слова, а разметка, оставшаяся открытой после обрезки,
+    закрывается (markdown=False - для текста без разметки), чтобы Telegram принял сообщение.
+    """
+    # Символ занимает не больше 2 единиц UTF-16 - короткий текст не кодируем
+    if len(text) * 2 <= limit:
+        return text
+    encoded = text.encode('utf-16-le')
+    if len(encoded) <= limit * 2:
+        return text
+    # Запас в 4 единицы - на закрытие блока кода "\n```"
+    max_units = limit - len(TRUNCATE_TEXT.encode('utf-16-le')) // 2 - 4
+    # errors='ignore' отбрасывает половину суррогатной пары на границе среза
+    cut = encoded[:max_units * 2].decode('utf-16-le', errors='ignore')
+    # Не режем слово посередине, если пробел недалеко от конца
+    space = max(cut.rfind(' '), cut.rfind('\n'))
+    if space > len(cut) - TRUNCATE_WORD_LOOKBACK:
+        cut = cut[:space]
+    if markdown:
+        cut = _close_markdown(cut)
+    return cut + TRUNCATE_TEXT
+
+def _render_db_response(topic_name, question, answer):
+    """Текст ответа из базы знаний для отправки (Markdown), не длиннее 4000 единиц UTF-16"""
+    return _truncate_message(f"*{topic_name}*\n\n*{question}*\n\n{answer}")
+
+def _render_lesson(topic_key, topic_data, question_index):
+    """Текст ответа в уроке (Markdown): прогресс темы, ответ и отметка о завершении темы"""
+    question_data = topic_data["content"][question_index]
+    answer_text = question_data["_display_answer"]
+    
+    # Прогресс и отметки - только для не-стартовых тем
+    if topic_key == "start":
+        return answer_text
+    
+    # Простой трекер прогресса в начале ответа
+    answer_text = topic_data["_progress_prefixes"][question_index] + answer_text
+    
+    # Добавляем индикатор завершения темы, если это последний вопрос
+    is_last_topic = topic_key == _LAST_TOPIC
+    if question_index == len(topic_data["content"]) - 1 and not is_last_topic:
+        answer_text += "\n\n---\n✅ *Тема завершена!* Нажми «Следующая тема ➡️» для продолжения."
+    elif "is_final" in question_data:
+        answer_text += "\n\n---\n🎉 *Поздравляю!* Вы завершили базовый курс!"
+    return answer_text
+
+def _prepare_knowledge_base():
+    """
+    Нормализует тексты базы знаний один раз при загрузке
+    
+    Добавляет к каждому вопросу нормализованные тексты и множества их слов
+    (см. _prepare_question), к каждой теме - поля _name_norm и _name_tokens
+    и _progress_prefixes (строка прогресса для каждого номера вопроса).
+    Готовит и тексты для отправки: _display_answer - ответ с подставленным названием бота,
+    _rendered_md - ответ на найденный вопрос, _lesson_md - ответ в уроке (см. _render_lesson).
+    """
+    for topic_data in TOPICS.values():
+        topic_data["_name_norm"] = normalize_text(topic_data.get("name", ""))
+        topic_data["_name_tokens"] = frozenset(topic_data["_name_norm"].split())
+        total_questions = len(topic_data.get("content", []))
+        topic_data["_progress_prefixes"] = tuple(
+            f"📊 *Прогресс:* {int(num / total_questions * 100)}% ({num}/{total_questions})\n\n"
+            for num in range(1, total_questions + 1)
+        )
+        for question_data in topic_data.get("content", []):
+            _prepare_question(question_data)
+            # Название бота не меняется во время работы - подставляем {bot_name} один раз
+            question_data["_display_answer"] = question_data.get("answer", "").replace("{bot_name}", config.BOT_NAME)
+    
+    for topic_key, topic_data in TOPICS.items():
+        for question_index, question_data in enumerate(topic_data.get("content", [])):
+            question_data["_rendered_md"] = _render_db_response(
+                topic_data.get("name", ""), question_data.get("question", ""), question_data["_display_answer"]
+            )
+            question_data["_lesson_md"] = _render_lesson(topic_key, topic_data, question_index)
+
+def _prepare_question(question_data):
+    """
+    Добавляет к вопросу нормализованные тексты, если их еще нет
+    
+    _q_norm/_a_norm - вопрос и ответ с пробелами по краям (для поиска фраз по границам слов),
+    _q_tokens/_a_tokens - множества их слов, _kw_norm - множество нормализованных ключевых слов
+    """
+    if "_q_norm" not in question_data:
+        question_norm = normalize_text(question_data.get("question", ""))
+        answer_norm = normalize_text(question_data.get("answer", ""))
+        question_data["_q_norm"] = f" {question_norm} "
+        question_data["_a_norm"] = f" {answer_norm} "
+        question_data["_q_tokens"] = frozenset(question_norm.split())
+        question_data["_a_tokens"] = frozenset(answer_norm.split())
+        question_data["_kw_norm"] = frozenset(normalize_text(kw) for kw in question_data.get("keywords", []))
+    return question_data
+
+_prepare_knowledge_base()
+
+# Названия тем: исходное название -> (нормализованное с пробелами по краям, множество слов)
+_TOPIC_NAME_NORM = {
+    topic_data.get("name", ""): (f" {topic_data['_name_norm']} ", topic_data["_name_tokens"])
+    for topic_data in TOPICS.values()
+}
+
+def _topic_texts(topic_name):
+    topic = _TOPIC_NAME_NORM.get(topic_name)
+    if topic is None:
+        topic_norm = normalize_text(topic_name)
+        topic = (f" {topic_norm} ", frozenset(topic_norm.split()))
+    return topic
+
+def _doc_fields(question_data, topic_name):
+    """Нормализованные поля вопроса в порядке аргументов _score_fields после query"""
+    return (question_data["_q_norm"], question_data["_a_norm"], question_data["_q_tokens"],
+            question_data["_a_tokens"], question_data["_kw_norm"], *_topic_texts(topic_name))
+
+def _doc_tokens(fields):
+    """Отдельные слова вопроса, дающие вес при совпадении (ключевые слова - только из одного слова)"""
+    _, _, question_tokens, answer_tokens, keywords, _, topic_tokens = fields
+    return question_tokens | answer_tokens | topic_tokens | {kw for kw in keywords if ' ' not in kw}
+
+def _token_weight(token, fields):
+    """
+    Вес совпадения слова запроса с вопросом (fields - результат _doc_fields):
+    в вопросе - очень высокий, в keywords - максимальный, в ответе и в названии темы - средний
+    """
+    _, _, question_tokens, answer_tokens, keywords, _, topic_tokens = fields
+    return (5.0 * (token in question_tokens) + 8.0 * (token in keywords)
+            + 2.0 * (token in answer_tokens) + 3.0 * (token in topic_tokens))
+
+# Плоский список вопросов базы знаний с нормализованными полями для оценки
+# (fields - аргументы _score_fields, см. _doc_fields): поиск не обращается к вложенным словарям
+Doc = namedtuple('Doc', ['topic_key', 'topic_name', 'question_data', 'fields'])
+
+# Инвертированный индекс базы знаний: слово -> номера вопросов в DOCS,
+# в тексте которых (вопрос, ответ, ключевые слова, название темы) оно встречается
+DOCS = []
+INVERTED = {}
+# Взвешенные списки вхождений: слово -> [(номер вопроса в DOCS, вес слова в этом вопросе)]
+POSTINGS = {}
+for _topic_key, _topic_data in TOPICS.items():
+    for _question_data in _topic_data.get("content", []):
+        _doc_id = len(DOCS)
+        _topic_name = _topic_data.get("name", "")
+        DOCS.append(Doc(_topic_key, _topic_name, _question_data, _doc_fields(_question_data, _topic_name)))
+        _texts = [_question_data["_q_norm"], _question_data["_a_norm"], _topic_data["_name_norm"], *_question_data["_kw_norm"]]
+        for _token in " ".join(_texts).split():
+            INVERTED.setdefault(_token, set()).add(_doc_id)
+        for _token in _doc_tokens(DOCS[-1].fields):
+            POSTINGS.setdefault(_token, []).append((_doc_id, _token_weight(_token, DOCS[-1].fields)))
+
+# Ключи синонимов в префиксном дереве - для поиска с учетом окончаний;
+# списки синонимов хранятся как frozenset (объединение множеств выполняется без повторного хеширования);
+# регистр приводится так же, как в normalize_text, чтобы ключи совпадали со словами запроса
+SYNONYM_TRIE = Trie(
+    (key.casefold(), frozenset(synonym.casefold() for synonym in synonyms))
+    for key, synonyms in SYNONYMS.items()
+)
+
+@functools.lru_cache(maxsize=4096)
+def _synonym_keys(word):
+    """
+    Ключи SYNONYMS, к которым относится слово
+    
+    Если слова нет ни в SYNONYMS, ни в текстах базы знаний, учитываются его формы:
+    ключ - начало слова ("апишки" -> "апи") или слово без окончания - начало ключа
+    ("регрессию" -> "регрессия"). Разница в длине - не больше 3 символов (типичное окончание).
+    Слова, которые есть в базе знаний, ищутся как есть - их формы не расширяются синонимами.
+    """
+    if word in SYNONYM_TRIE:
+        return (word,)
+    if word in INVERTED:
+        return ()
+    keys = []
+    key = SYNONYM_TRIE.longest_prefix(word)
+    if key and len(key) >= 3 and len(word) - len(key) <= 3:
+        keys.append(key)
+    if len(word) >= 5:
+        stem = word[:-2]
+        keys.extend(key for key, _ in SYNONYM_TRIE.items(stem) if len(key) - len(stem) <= 3 and key not in keys)
+    return tuple(keys)
+
+@functools.lru_cache(maxsize=4096)
+def _expand_one(word):
+    """Слово вместе с его синонимами (кэшируется: одни и те же слова повторяются в разных запросах)"""
+    expanded = {word}
+    for key in _synonym_keys(word):
+        # Для формы слова добавляется и сам ключ ("регрессию" -> "регрессия")
+        expanded.add(key)
+        expanded.update(SYNONYM_TRIE.get(key))
+    return frozenset(expanded)
 
 def expand_with_synonyms(words):
     """Расширяет список слов синонимами"""
-    expanded = set(words)
-    for word in words:
-        if word in SYNONYMS:
-            expanded.update(SYNONYMS[word])
-    return expanded
-
-def calculate_relevance_score(query_words, question_data, topic_name):
-    """Вычисляет релевантность вопроса запросу пользователя"""
-    score = 0.0
+    return set().union(*map(_expand_one, words))
+
+# Слова базы знаний в префиксном дереве - для поиска слов с опечатками
+VOCAB_TRIE = Trie(INVERTED.items())
+
+# Множитель весов совпадения для слова с опечаткой в зависимости от числа правок
+FUZZY_WEIGHTS = {1: 0.5, 2: 0.25}
+
+# Недописанное слово: множитель веса и сколько самых коротких продолжений учитывать
+PREFIX_WEIGHT = 0.5
+PREFIX_MAX_COMPLETIONS = 10
+
+@functools.lru_cache(maxsize=4096)
+def _fuzzy_terms(word):
+    """
+    Слова базы знаний, похожие на слово запроса с опечаткой или недописанное слово
     
-    # Получаем текст для поиска
-    question_text = normalize_text(question_data.get("question", ""))
-    answer_text = normalize_text(question_data.get("answer", ""))
-    keywords = question_data.get("keywords", [])
-    topic_text = normalize_text(topic_name)
+    Ищутся только для слов, которых нет ни в базе знаний, ни в SYNONYMS (с учетом форм).
+    Допускается 1 правка для слов короче 6 букв и 2 правки для более длинных;
+    недописанное слово дополняется словами базы, которые с него начинаются
+    ("автомат" -> "автоматизация"), - не больше PREFIX_MAX_COMPLETIONS самых коротких.
     
-    # Проверка на точное совпадение фразы (высокий приоритет)
-    query_phrase = ' '.join(query_words)
-    query_phrase_2 = ' '.join(query_words[:2]) if len(query_words) >= 2 else ""
-    query_phrase_3 = ' '.join(query_words[:3]) if len(query_words) >= 3 else ""
+    Returns:
+        Кортеж пар (слово базы знаний, множитель веса)
+    """
+    if (len(word) < config.SEARCH_CONFIG['fuzzy_min_length'] or word.isdigit()
+            or word in INVERTED or _synonym_keys(word)):
+        return ()
+    max_distance = 1 if len(word) < 6 else 2
+    matches = {
+        token: FUZZY_WEIGHTS[distance]
+        for token, _, distance in VOCAB_TRIE.fuzzy_items(word, max_distance)
+    }
+    completions = sorted((token for token, _ in VOCAB_TRIE.items(word)), key=lambda token: (len(token), token))
+    for token in completions[:PREFIX_MAX_COMPLETIONS]:
+        matches[token] = max(PREFIX_WEIGHT, matches.get(token, 0.0))
+    return tuple(sorted(matches.items()))
+
+@functools.lru_cache(maxsize=1024)
+def _expanded_terms(query_words):
+    """
+    Запрос, расширенный синонимами и исправлениями опечаток
     
+    Returns:
+        (все термины, однословные термины, многословные фразы с пробелами по краям,
+        пары (слово базы знаний вместо слова с опечаткой, множитель веса))
+    """
+    expanded = frozenset(expand_with_synonyms(query_words))
+    single = frozenset(word for word in expanded if ' ' not in word)
+    phrases = tuple(f" {word} " for word in expanded if ' ' in word)
+    fuzzy = {}
+    if config.SEARCH_CONFIG['use_fuzzy']:
+        for word in query_words:
+            for token, weight in _fuzzy_terms(word):
+                fuzzy[token] = max(weight, fuzzy.get(token, 0.0))
+    return expanded, single, phrases, tuple(fuzzy.items())
+
+@functools.lru_cache(maxsize=1024)
+def _phrase_ladder(query_words):
+    """
+    Фразы запроса для бонуса за совпадение: первые 2 слова, первые 3 слова, весь запрос
+    
+    Returns:
+        Кортеж (фраза с пробелами по краям, бонус в вопросе, бонус в ответе)
+        от короткой фразы к длинной; каждая фраза - начало следующей
+    """
+    ladder = []
+    if len(query_words) > 2:
+        ladder.append((f" {' '.join(query_words[:2])} ", 12.0, 5.0))
+    if len(query_words) > 3:
+        ladder.append((f" {' '.join(query_words[:3])} ", 15.0, 7.0))
+    ladder.append((f" {' '.join(query_words)} ", 20.0, 10.0))
+    return tuple(ladder)
+
+def _phrase_bonus(text, ladder, weight_index):
+    """
+    Бонус за самую длинную фразу запроса, найденную в тексте
+    
+    Фразы вложены: если короткая не найдена, длинных в тексте тоже нет,
+    поэтому при отсутствии совпадения текст просматривается один раз.
+    """
+    bonus = 0.0
+    for phrase in ladder:
+        if phrase[0] not in text:
+            break
+        bonus = phrase[weight_index]
+    return bonus
+
+# Запрос, подготовленный для оценки: вычисляется один раз на запрос, а не на каждый вопрос базы
+PreparedQuery = namedtuple('PreparedQuery', ['words', 'ladder', 'expanded', 'single_words', 'phrases', 'fuzzy'])
+
+def _prepare_query(query_words):
+    """Готовит слова запроса (кортеж) к оценке: фразы для бонуса, расширение синонимами и опечатки"""
+    return PreparedQuery(query_words, _phrase_ladder(query_words), *_expanded_terms(query_words))
+
+def calculate_relevance_score(query_words, question_data, topic_name, query=None):
+    """
+    Вычисляет релевантность вопроса запросу пользователя
+    
+    query - результат _prepare_query(query_words); передается при оценке многих
+    вопросов по одному запросу, чтобы не готовить запрос заново
+    """
+    if query is None:
+        query = _prepare_query(tuple(query_words))
+    
+    # Получаем текст для поиска (нормализован заранее при загрузке базы знаний)
+    return _score_fields(query, *_doc_fields(_prepare_question(question_data), topic_name))
+
+def _score_fields(query, question_text, answer_text, question_tokens, answer_tokens, keywords, topic_text, topic_tokens):
+    """Оценка релевантности по заранее нормализованным полям вопроса (см. _doc_fields)"""
+    single_words = query.single_words
+    # Ни одного общего слова и нет фраз или опечаток, которые могли бы совпасть, - оценка 0,
+    # остальные проверки (поиск фраз в тексте) не нужны
+    if (not query.phrases and not query.fuzzy
+            and single_words.isdisjoint(question_tokens) and single_words.isdisjoint(answer_tokens)
+            and single_words.isdisjoint(topic_tokens) and query.expanded.isdisjoint(keywords)):
+        return 0.0
+    
+    score = 0.0
+    
+    # Проверка на точное совпадение фразы по границам слов (высокий приоритет)
     # Очень высокий бонус за точное совпадение фразы в вопросе
-    if query_phrase in question_text:
-        score += 20.0
-    elif query_phrase_3 and query_phrase_3 in question_text:
-        score += 15.0
-    elif query_phrase_2 and query_phrase_2 in question_text:
-        score += 12.0
+    score += _phrase_bonus(question_text, query.ladder, 1)
     
     # Высокий бонус за точное совпадение фразы в ответе
-    if query_phrase in answer_text:
-        score += 10.0
-    elif query_phrase_3 and query_phrase_3 in answer_text:
-        score += 7.0
-    elif query_phrase_2 and query_phrase_2 in answer_text:
-        score += 5.0
-    
-    # Расширяем запрос синонимами
-    expanded_query = expand_with_synonyms(query_words)
-    
-    # Подсчет совпадений отдельных слов
-    for word in expanded_query:
-        # Совпадение в вопросе - очень высокий вес
-        if word in question_text:
+    score += _phrase_bonus(answer_text, query.ladder, 2)
+    
+    # Запрос, расширенный синонимами
+    expanded_query, phrases = query.expanded, query.phrases
+    
+    # Подсчет совпадений отдельных слов (целыми словами, пересечением множеств):
+    # в вопросе - очень высокий вес, в keywords - максимальный,
+    # в ответе и в названии темы - средний
+    score += 5.0 * len(single_words & question_tokens)
+    score += 8.0 * len(expanded_query & keywords)
+    score += 2.0 * len(single_words & answer_tokens)
+    score += 3.0 * len(single_words & topic_tokens)
+    
+    # Синонимы из нескольких слов ищем как фразу
+    for phrase in phrases:
+        if phrase in question_text:
             score += 5.0
-        # Совпадение в keywords - максимальный вес
-        if word in [normalize_text(kw) for kw in keywords]:
-            score += 8.0
-        # Совпадение в ответе - средний вес
-        if word in answer_text:
+        if phrase in answer_text:
             score += 2.0
-        # Совпадение в названии темы - средний вес
-        if word in topic_text:
+        if phrase in topic_text:
             score += 3.0
     
+    # Слова с опечатками - те же веса, уменьшенные по числу правок
+    fields = (question_text, answer_text, question_tokens, answer_tokens, keywords, topic_text, topic_tokens)
+    for token, weight in query.fuzzy:
+        score += weight * _token_weight(token, fields)
+    
     # Бонус если все слова запроса найдены в вопросе
-    words_in_question = sum(1 for word in query_words if word in question_text)
-    if words_in_question == len(query_words) and len(query_words) > 0:
+    if query.words and question_tokens.issuperset(query.words):
         score += 10.0
     
     return score
 
+def _score_postings(query):
+    """
+    Оценки вопросов по взвешенному индексу POSTINGS - то же, что _score_fields, для всех вопросов сразу
+    
+    Веса отдельных слов суммируются по спискам вхождений; фразы (многословные синонимы,
+    бонусы за фразу запроса и за все слова в вопросе) проверяются только у найденных вопросов.
+    
+    Returns:
+        Словарь номер вопроса в DOCS -> оценка (только вопросы с ненулевой оценкой)
+    """
+    scores = {}
+    for token in query.single_words:
+        for doc_id, weight in POSTINGS.get(token, ()):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight
+    for token, factor in query.fuzzy:
+        for doc_id, weight in POSTINGS.get(token, ()):
+            scores[doc_id] = scores.get(doc_id, 0.0) + factor * weight
+    
+    # Многословные синонимы: совпадение с ключевым словом и фраза в текстах.
+    # Фраза может быть в тексте, только если в нем есть ее первое слово
+    for term in query.expanded - query.single_words:
+        phrase = f" {term} "
+        for doc_id in INVERTED.get(term.split()[0], ()):
+            question_text, answer_text, _, _, keywords, topic_text, _ = DOCS[doc_id].fields
+            bonus = (8.0 * (term in keywords) + 5.0 * (phrase in question_text)
+                     + 2.0 * (phrase in answer_text) + 3.0 * (phrase in topic_text))
+            if bonus:
+                scores[doc_id] = scores.get(doc_id, 0.0) + bonus
+    
+    # Фраза запроса и все слова запроса в вопросе: в таком вопросе есть слова запроса,
+    # значит, он уже получил оценку выше
+    for doc_id in scores:
+        question_text, answer_text, question_tokens = DOCS[doc_id].fields[:3]
+        bonus = _phrase_bonus(question_text, query.ladder, 1) + _phrase_bonus(answer_text, query.ladder, 2)
+        if query.words and question_tokens.issuperset(query.words):
+            bonus += 10.0
+        scores[doc_id] += bonus
+    return scores
+
 def search_in_knowledge_base(query):
     """Интеллектуальный поиск по базе знаний"""
     if not query or len(query.strip()) < 2:
         return []
     
-    # Нормализуем запрос
-    normalized_query = normalize_text(query)
-    query_words = normalized_query.split()
+    # Нормализуем запрос; одинаковые после нормализации запросы берутся из кэша
+    return list(_search_cached(_normalize_query(query)))
+
+# Нормализация запросов пользователей с кэшем: частые сообщения ("что такое баг") повторяются.
+# Тексты базы знаний нормализуются один раз при загрузке и в этот кэш не попадают
+_normalize_query = functools.lru_cache(maxsize=1024)(normalize_text)
+
+def clear_search_cache():
+    """
+    Очищает кэши поиска
+    
+    Вызывайте после изменения базы знаний во время работы бота
+    (сами индексы DOCS, INVERTED и POSTINGS строятся при импорте и не пересобираются).
+    """
+    for cached in (_normalize_query, _search_cached, _expanded_terms, _phrase_ladder,
+                   _expand_one, _synonym_keys, _fuzzy_terms):
+        cached.cache_clear()
+
+@functools.lru_cache(maxsize=1024)
+def _search_cached(normalized_query):
+    """
+    Поиск по нормализованному запросу с кэшированием результатов
+    
+    Returns:
+        Кортеж неизменяемых результатов (MappingProxyType) - общие для всех вызовов
+    """
+    query_words = tuple(normalized_query.split())
     
     if not query_words:
-        return []
+        return ()
     
-    # Расширяем запрос синонимами
-    expanded_query = expand_with_synonyms(query_words)
+    # Фразы и расширение синонимами готовим один раз на запрос
+    query = _prepare_query(query_words)
     
     results = []
     
-    # Ищем по всем темам и вопросам
-    for topic_key, topic_data in TOPICS.items():
-        topic_name = topic_data.get("name", "")
+    for doc_id, score in sorted(_score_postings(query).items()):
+        topic_key, topic_name, question_data, _ = DOCS[doc_id]
         
-        for question_data in topic_data.get("content", []):
-            score = calculate_relevance_score(query_words, question_data, topic_name)
-            
-            if score >= config.SEARCH_CONFIG['min_relevance_score']:
-                results.append({
-                    'score': score,
-                    'topic_key': topic_key,
-                    'topic_name': topic_name,
-                    'question': question_data.get("question", ""),
-                    'answer': question_data.get("answer", ""),
-                    'keywords': question_data.get("keywords", [])
-                })
-    
-    # Сортируем по релевантности (от большего к меньшему)
-    results.sort(key=lambda x: x['score'], reverse=True)
-    
-    # Возвращаем топ результатов
-    return results[:config.SEARCH_CONFIG['max_results']]
+        if score >= config.SEARCH_CONFIG['min_relevance_score']:
+            results.append({
+                'score': score,
+                'topic_key': topic_key,
+                'topic_name': topic_name,
+                'question': question_data.get("question", ""),
+                'answer': question_data["_display_answer"],
+                'keywords': tuple(question_data.get("keywords", [])),
+                'rendered': question_data["_rendered_md"]
+            })
+    
+    # Возвращаем топ результатов по релевантности (от большего к меньшему)
+    top = heapq.nlargest(config.SEARCH_CONFIG['max_results'], results, key=lambda x: x['score'])
+    return tuple(MappingProxyType(result) for result in top)
+
+# Тексты кнопок клавиатуры (по ним же срабатывают обработчики кнопок)
+BTN_START = "Старт 🚀"
+BTN_BACK = "Назад ◀️"
+BTN_PREV = "Предыдущий вопрос ↩️"
+BTN_NEXT = "Следующая тема ➡️"
+BTN_HOME = "На главную 🏠"
+BTN_ASK = "Задать вопрос ❓"
+BTN_COMMANDS = "📋 Команды"
+BTN_TOPICS = "📖 Список тем"
 
 def create_keyboard(with_start=False, with_back=False, with_prev=False, with_next=False, with_home=False, with_cancel=False, with_commands=False):
-    """Создаем клавиатуру с нужными кнопками"""
+    """
+    Создаем клавиатуру с нужными кнопками
+    
+    Returns:
+        JSON разметки клавиатуры (строка) для параметра reply_markup.
+        Клавиатура для каждого набора кнопок создается и сериализуется один раз:
+        строку telebot передает в API как есть, не вызывая to_json при каждой отправке.
+    """
+    return _keyboard_for((with_start, with_back, with_prev, with_next, with_home, with_cancel, with_commands))
+
+@functools.lru_cache(maxsize=64)
+def _keyboard_for(flags):
+    """JSON клавиатуры для кортежа флагов в порядке аргументов create_keyboard"""
+    with_start, with_back, with_prev, with_next, with_home, with_cancel, with_commands = flags
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     buttons = []
 
     if with_start:
-        buttons.append("Старт 🚀")
+        buttons.append(BTN_START)
     if with_back:
-        buttons.append("Назад ◀️")
+        buttons.append(BTN_BACK)
     if with_prev:
-        buttons.append("Предыдущий вопрос ↩️")
+        buttons.append(BTN_PREV)
     if with_next:
-        buttons.append("Следующая тема ➡️")
+        buttons.append(BTN_NEXT)
     if with_home:
-        buttons.append("На главную 🏠")
+        buttons.append(BTN_HOME)
     if with_cancel:
-        buttons.append("Задать вопрос ❓")
+        buttons.append(BTN_ASK)
     if with_commands:
-        buttons.append("📋 Команды")
-        buttons.append("📖 Список тем")
+        buttons.append(BTN_COMMANDS)
+        buttons.append(BTN_TOPICS)
 
     markup.add(*buttons)
-    return markup
+    return markup.to_json()
 
 # Константы для сообщений
 NOT_FOUND_MESSAGE = """😔 Я не нашел точного ответа на твой вопрос.
@@ -174,39 +614,90 @@ SEARCH_NOT_FOUND_MESSAGE = """Попробуй:
 • Использовать /topics для просмотра всех тем"""
 
 def format_response_from_db(result):
-    """Форматирует ответ из базы знаний"""
-    response = f"*{result['topic_name']}*\n\n"
-    response += f"*{result['question']}*\n\n"
-    response += result['answer']
+    """Форматирует ответ из базы знаний (у результатов поиска текст подготовлен заранее)"""
+    rendered = result.get('rendered')
+    if rendered is None:
+        rendered = _render_db_response(result['topic_name'], result['question'], result['answer'])
+    return rendered
+
+async def stream_ai_answer(chat_id, question):
+    """
+    Получает ответ от AI потоково, показывая его в черновом сообщении по мере генерации
     
-    # Обрезаем так, чтобы итоговая длина была <= 4000 (с учетом текста обрезки)
-    truncate_text = "\n\n... (сообщение обрезано)"
-    max_length = 4000 - len(truncate_text)
+    Returns:
+        tuple: (ответ AI или None, черновое сообщение или None)
+    """
+    update_chars = config.FORMATTING_CONFIG['stream_update_chars']
+    update_interval = config.FORMATTING_CONFIG['stream_update_interval']
+    parts = []
+    received = 0
+    shown = 0
+    last_update = 0.0
+    draft = None
     
-    if len(response) > 4000:
-        # Обрезаем до max_length и добавляем текст обрезки
-        response = response[:max_length] + truncate_text
+    try:
+        async for delta in ai_helper.ask_ai_stream(question):
+            parts.append(delta)
+            received += len(delta)
+            now = time.monotonic()
+            if received - shown < update_chars or now - last_update < update_interval:
+                continue
+            
+            # Черновик без разметки: незакрытый Markdown в середине ответа Telegram не примет
+            text = _truncate_message("🤖 Ответ от AI:\n\n" + "".join(parts), markdown=False)
+            try:
+                if draft is None:
+                    draft = await bot.send_message(chat_id, text)
+                else:
+                    await bot.edit_message_text(text, chat_id, draft.message_id)
+            except Exception as e:
+                print(f"[WARNING] Error updating AI draft message: {e}")
+            shown = received
+            last_update = now
+    except Exception as e:
+        print(f"[ERROR] Error streaming AI response: {e}")
+        return None, draft
     
-    return response
+    answer = "".join(parts).strip()
+    return answer or None, draft
+
+async def _keep_typing(chat_id):
+    """Повторяет статус "печатает" (Telegram показывает его около 5 секунд), пока задачу не отменят"""
+    while True:
+        await asyncio.sleep(4)
+        try:
+            await bot.send_chat_action(chat_id, 'typing')
+        except Exception as e:
+            print(f"[WARNING] Error sending typing action: {e}")
 
-def send_ai_response(chat_id, question):
+async def send_ai_response(chat_id, question):
     """Отправляет ответ от AI, если он доступен"""
     if not config.AI_CONFIG['enabled'] or not config.AI_CONFIG['use_fallback']:
         return False
     
-    bot.send_chat_action(chat_id, 'typing')
-    ai_response = ai_helper.ask_ai(question)
+    await bot.send_chat_action(chat_id, 'typing')
+    # Пока AI думает, пользователь видит "печатает", а не тишину
+    typing = asyncio.create_task(_keep_typing(chat_id))
+    try:
+        ai_response, draft = await stream_ai_answer(chat_id, question)
+    finally:
+        typing.cancel()
+    
+    if draft is not None:
+        # Черновик заменяем итоговым сообщением с разметкой и клавиатурой
+        # (reply-клавиатуру нельзя добавить при редактировании сообщения)
+        try:
+            await bot.delete_message(chat_id, draft.message_id)
+        except Exception as e:
+            print(f"[WARNING] Error deleting AI draft message: {e}")
     
     if ai_response:
         response = f"🤖 *Ответ от AI:*\n\n{ai_response}\n\n"
         response += "💡 *Совет:* Используй /topics для изучения структурированных тем."
         
-        if len(response) > 4000:
-            response = response[:4000] + "\n\n... (сообщение обрезано)"
-        
-        bot.send_message(
+        await bot.send_message(
             chat_id,
-            response,
+            _truncate_message(response),
             parse_mode="Markdown",
             reply_markup=create_keyboard(with_home=True)
         )
@@ -214,7 +705,12 @@ def send_ai_response(chat_id, question):
     
     return False
 
-def send_not_found_message(chat_id, query=None, is_search=False):
+async def send_ai_fallback(chat_id, query, is_search=False):
+    """Отвечает через AI; если ответа AI нет - сообщает, что ничего не найдено"""
+    if not await send_ai_response(chat_id, query):
+        await send_not_found_message(chat_id, query=query, is_search=is_search)
+
+async def send_not_found_message(chat_id, query=None, is_search=False):
     """Отправляет сообщение о том, что ничего не найдено"""
     if is_search and query:
         safe_query = security.escape_markdown(query)
@@ -224,7 +720,7 @@ def send_not_found_message(chat_id, query=None, is_search=False):
     else:
         message = NOT_FOUND_MESSAGE
     
-    bot.send_message(
+    await bot.send_message(
         chat_id,
         message,
         parse_mode="Markdown",
@@ -250,85 +746,32 @@ def validate_and_sanitize_input(raw_input, max_length=None, is_search=False):
     else:
         return raw_input, True, None
 
-def process_search_results(chat_id, query, results, is_search=False):
+async def process_search_results(chat_id, query, results, is_search=False):
     """Обрабатывает результаты поиска и отправляет ответ"""
     if not results:
         # Ничего не найдено - используем AI
-        if not send_ai_response(chat_id, query):
-            send_not_found_message(chat_id, query=query, is_search=is_search)
+        await send_ai_fallback(chat_id, query, is_search)
         return
     
-    result = results[0]
-    score = result['score']
-    
-    # Если очень высокий score - проверяем релевантность через AI (если доступен)
-    # Это важно, чтобы не показывать нерелевантные результаты даже с высоким score
-    if score >= config.SEARCH_CONFIG['high_relevance_score']:
-        # Проверяем релевантность через AI, если он доступен
-        is_relevant = ai_helper.check_relevance(
-            query,
-            result['question'],
-            result['answer']
-        )
-        
-        # Если AI недоступен (None) - для высокого score показываем результат
-        # (высокий score обычно означает хорошее совпадение)
-        if is_relevant is None:
-            response = format_response_from_db(result)
-            bot.send_message(
-                chat_id,
-                response,
-                parse_mode="Markdown",
-                reply_markup=create_keyboard(with_home=True)
-            )
-            return
-        
-        # Если AI считает нерелевантным (False) - используем AI fallback
-        if is_relevant is False:
-            if not send_ai_response(chat_id, query):
-                send_not_found_message(chat_id, query=query, is_search=is_search)
-            return
-        
-        # AI подтвердил релевантность (True) - показываем ответ из базы
-        if is_relevant is True:
-            response = format_response_from_db(result)
-            bot.send_message(
-                chat_id,
-                response,
-                parse_mode="Markdown",
-                reply_markup=create_keyboard(with_home=True)
-            )
-            return
+    # Кандидаты с достаточным score проверяем через AI одним запросом
+    candidates = [result for result in results if result['score'] >= config.SEARCH_CONFIG['min_relevance_score']]
+    # Если включено - ответ AI готовится параллельно с проверкой на случай fallback
+    speculative = ai_helper.start_speculative_answer(query) if candidates else None
+    verdicts = await ai_helper.check_relevance_many(
+        query,
+        [(result['question'], result['answer']) for result in candidates]
+    )
     
-    # Если средний score - проверяем релевантность через AI
-    if score >= config.SEARCH_CONFIG['min_relevance_score']:
-        is_relevant = ai_helper.check_relevance(
-            query,
-            result['question'],
-            result['answer']
-        )
-        
-        # Если AI считает нерелевантным (False) - всегда используем AI fallback
-        if is_relevant is False:
-            # AI явно сказал, что нерелевантно - используем AI fallback
-            if not send_ai_response(chat_id, query):
-                # AI не настроен - показываем сообщение "не найдено"
-                send_not_found_message(chat_id, query=query, is_search=is_search)
-            return
-        
-        # Если AI недоступен (None) - для среднего score лучше использовать AI fallback
-        if is_relevant is None:
-            # AI недоступен для проверки - используем AI fallback для ответа
-            if not send_ai_response(chat_id, query):
-                # AI не настроен - для среднего score лучше показать "не найдено", 
-                # чем показывать потенциально нерелевантный ответ
-                send_not_found_message(chat_id, query=query, is_search=is_search)
-            return
-        
-        # AI подтвердил релевантность (True) - показываем ответ из базы
-        if is_relevant is True:
+    for result, is_relevant in zip(candidates, verdicts):
+        # AI подтвердил релевантность (True) - показываем ответ из базы.
+        # Если AI недоступен (None) - показываем только результат с высоким score
+        # (высокий score обычно означает хорошее совпадение); для среднего score
+        # лучше использовать AI fallback, чем показывать потенциально нерелевантный ответ
+        if is_relevant or (is_relevant is None and result['score'] >= config.SEARCH_CONFIG['high_relevance_score']):
+            if speculative:
+                speculative.cancel()
             response = format_response_from_db(result)
-            bot.send_message(
+            await bot.send_message(
                 chat_id,
                 response,
                 parse_mode="Markdown",
@@ -336,21 +779,20 @@ def process_search_results(chat_id, query, results, is_search=False):
             )
             return
     
-    # Score слишком низкий (< 5.0) - используем AI
-    if not send_ai_response(chat_id, query):
-        send_not_found_message(chat_id, query=query, is_search=is_search)
+    # Релевантных ответов нет или score слишком низкий (< 5.0) - используем AI
+    await send_ai_fallback(chat_id, query, is_search)
 
-def show_question(user_id, chat_id):
+async def show_question(user_id, chat_id):
     """Показываем текущий вопрос пользователю"""
     session = get_user_session(user_id)
-    topic_key = session["current_topic"]
-    question_index = session["current_question_index"]
+    topic_key = session.current_topic
+    question_index = session.current_question_index
 
     # Проверка существования темы
     if topic_key not in TOPICS:
         # Если тема не найдена, возвращаемся на старт
-        session["current_topic"] = "start"
-        session["current_question_index"] = 0
+        session.current_topic = "start"
+        session.current_question_index = 0
         topic_key = "start"
     
     topic = TOPICS[topic_key]
@@ -358,21 +800,21 @@ def show_question(user_id, chat_id):
     # Проверка индекса вопроса
     if question_index >= len(topic["content"]) or question_index < 0:
         question_index = 0
-        session["current_question_index"] = 0
+        session.current_question_index = 0
     
     question_data = topic["content"][question_index]
 
     # Отправляем вопрос (для стартовой темы не показываем название)
     if topic_key == "start" and "is_welcome" in question_data:
         # Для стартового сообщения показываем только вопрос без названия темы
-        bot.send_message(
+        await bot.send_message(
             chat_id,
             question_data['question'],
             parse_mode="Markdown"
         )
     else:
         # Для остальных тем показываем название темы
-        bot.send_message(
+        await bot.send_message(
             chat_id,
             f"**{topic['name']}**\n\n*Вопрос:* {question_data['question']}",
             parse_mode="Markdown"
@@ -380,11 +822,10 @@ def show_question(user_id, chat_id):
 
     # Определяем, какие кнопки показывать
     is_first_topic = topic_key == "start"
-    is_last_topic = topic_key == TOPIC_ORDER[-1]
+    is_last_topic = topic_key == _LAST_TOPIC
     is_first_question = question_index == 0
     is_last_question = question_index == len(topic["content"]) - 1
     has_welcome = "is_welcome" in question_data
-    has_final = "is_final" in question_data
 
     # Создаем клавиатуру
     markup = create_keyboard(
@@ -396,51 +837,86 @@ def show_question(user_id, chat_id):
         with_commands=is_first_topic  # Показываем команды только на старте
     )
 
-    # Отправляем ответ (возможно, с задержкой для эффекта "печатает")
-    bot.send_chat_action(chat_id, 'typing')
-    # Имитируем небольшую задержку для лучшего UX
-    import time
-    time.sleep(0.5)
-
-    # Расчет прогресса темы (только для не-стартовых тем)
-    answer_text = question_data["answer"]
-    # Заменяем {bot_name} на реальное название бота
-    if "{bot_name}" in answer_text:
-        answer_text = answer_text.format(bot_name=config.BOT_NAME)
-    if not is_first_topic:
-        total_questions = len(topic["content"])
-        current_question_num = question_index + 1
-        progress_percent = int((current_question_num / total_questions) * 100)
-        
-        # Простой трекер прогресса в начале ответа
-        progress_text = f"📊 *Прогресс:* {progress_percent}% ({current_question_num}/{total_questions})\n\n"
-        answer_text = progress_text + answer_text
-        
-        # Добавляем индикатор завершения темы, если это последний вопрос
-        if is_last_question and not is_last_topic:
-            answer_text += "\n\n---\n✅ *Тема завершена!* Нажми «Следующая тема ➡️» для продолжения."
-        elif has_final:
-            answer_text += "\n\n---\n🎉 *Поздравляю!* Вы завершили базовый курс!"
+    # Показываем "печатает" (Telegram держит статус несколько секунд, задержка не нужна)
+    await bot.send_chat_action(chat_id, 'typing')
+
+    # Прогресс темы, ответ и отметка о завершении подготовлены при загрузке базы знаний
+    answer_text = question_data["_lesson_md"]
 
-    bot.send_message(
+    await bot.send_message(
         chat_id,
         answer_text,
         reply_markup=markup,
         parse_mode="Markdown"
     )
 
+# Навигация по курсу: функции меняют позицию в сессии и возвращают None,
+# либо текст сообщения, если дальше (или назад) перейти нельзя
+COURSE_END_MESSAGE = "Поздравляю! Вы завершили базовый курс! 🎉"
+COURSE_START_MESSAGE = "Вы уже в начале обучения!"
+
+def _advance_topic(session):
+    """Переход к первому вопросу следующей темы"""
+    current_index = _TOPIC_POS.get(session.current_topic)
+    if current_index is None:
+        # Если тема не найдена в порядке, возвращаемся на старт
+        session.current_topic = "start"
+    elif current_index < _NUM_TOPICS - 1:
+        session.current_topic = TOPIC_ORDER[current_index + 1]
+    else:
+        return COURSE_END_MESSAGE
+    session.current_question_index = 0
+    return None
+
+def _retreat_topic(session, to_last_question=False):
+    """Переход к предыдущей теме: к ее первому вопросу или, если to_last_question, к последнему"""
+    current_index = _TOPIC_POS.get(session.current_topic)
+    if current_index is None:
+        session.current_topic = "start"
+        session.current_question_index = 0
+        return None
+    if current_index == 0:
+        return COURSE_START_MESSAGE
+    session.current_topic = TOPIC_ORDER[current_index - 1]
+    session.current_question_index = len(TOPICS[session.current_topic]["content"]) - 1 if to_last_question else 0
+    return None
+
+def _advance_question(session):
+    """Переход к следующему вопросу темы, а после последнего - к следующей теме"""
+    topic = TOPICS.get(session.current_topic)
+    if topic is not None and session.current_question_index < len(topic["content"]) - 1:
+        session.current_question_index += 1
+        return None
+    return _advance_topic(session)
+
+def _retreat_question(session):
+    """Переход к предыдущему вопросу темы, а с первого - к последнему вопросу предыдущей темы"""
+    if session.current_question_index > 0:
+        session.current_question_index -= 1
+        return None
+    return _retreat_topic(session, to_last_question=True)
+
+async def _navigate(message, step):
+    """Выполняет шаг навигации и показывает новый вопрос или сообщение, почему перейти нельзя"""
+    user_id = message.from_user.id
+    error_msg = step(get_user_session(user_id))
+    if error_msg:
+        await bot.send_message(message.chat.id, error_msg)
+    else:
+        await show_question(user_id, message.chat.id)
+
 @bot.message_handler(commands=['start'])
-def send_welcome(message):
+async def send_welcome(message):
     """Обработчик команды /start"""
     user_id = message.from_user.id
     session = get_user_session(user_id)
-    session["current_topic"] = "start"
-    session["current_question_index"] = 0
+    session.current_topic = "start"
+    session.current_question_index = 0
 
-    show_question(user_id, message.chat.id)
+    await show_question(user_id, message.chat.id)
 
 @bot.message_handler(commands=['help'])
-def send_help(message):
+async def send_help(message):
     """Обработчик команды /help"""
     help_text = f"""
 *📚 {config.BOT_NAME} — Учитель по тестированию*
@@ -470,10 +946,10 @@ def send_help(message):
 © 2025 QA Ментор создан Михаилом Губенко. Все права защищены.
 Лицензия: GPL-3.0
     """
-    bot.send_message(message.chat.id, help_text, parse_mode="Markdown")
+    await bot.send_message(message.chat.id, help_text, parse_mode="Markdown")
 
 @bot.message_handler(commands=['license'])
-def send_license(message):
+async def send_license(message):
     """Обработчик команды /license"""
     license_text = f"""
 *📜 Лицензия*
@@ -493,33 +969,37 @@ https://github.com/mihaelgubenko/QA---mentor
 
 Полный текст лицензии: /help
     """
-    bot.send_message(message.chat.id, license_text, parse_mode="Markdown")
+    await bot.send_message(message.chat.id, license_text, parse_mode="Markdown")
 
-@bot.message_handler(commands=['topics'])
-def send_topics(message):
-    """Обработчик команды /topics"""
-    topics_text = "*📖 Список тем для изучения:*\n\n"
-    
+def _build_topics_text():
+    """Текст списка тем для /topics (собирается один раз при загрузке)"""
+    parts = ["*📖 Список тем для изучения:*\n\n"]
     for i, topic_key in enumerate(TOPIC_ORDER, 1):
         topic = TOPICS.get(topic_key, {})
         name = topic.get("name", "Неизвестная тема")
         description = topic.get("description", "")
-        topics_text += f"{i}. {name}\n"
+        parts.append(f"{i}. {name}\n")
         if description:
-            topics_text += f"   _{description}_\n"
-        topics_text += "\n"
-    
-    topics_text += "Используй кнопки навигации или /start для начала обучения!"
-    bot.send_message(message.chat.id, topics_text, parse_mode="Markdown")
+            parts.append(f"   _{description}_\n")
+        parts.append("\n")
+    parts.append("Используй кнопки навигации или /start для начала обучения!")
+    return "".join(parts)
+
+TOPICS_TEXT = _build_topics_text()
+
+@bot.message_handler(commands=['topics'])
+async def send_topics(message):
+    """Обработчик команды /topics"""
+    await bot.send_message(message.chat.id, TOPICS_TEXT, parse_mode="Markdown")
 
 @bot.message_handler(commands=['search'])
-def handle_search(message):
+async def handle_search(message):
     """Обработчик команды /search"""
     # Извлекаем запрос из команды
     raw_query = message.text.replace('/search', '').strip()
     
     if not raw_query:
-        bot.send_message(
+        await bot.send_message(
             message.chat.id,
             "❌ Укажи запрос для поиска!\n\n"
             "*Пример:* /search что такое баг",
@@ -531,7 +1011,7 @@ def handle_search(message):
     query, is_valid, error_msg = validate_and_sanitize_input(raw_query, is_search=True)
     
     if not is_valid:
-        bot.send_message(
+        await bot.send_message(
             message.chat.id,
             f"⚠️ {error_msg}\n\n"
             "Пожалуйста, переформулируй запрос.",
@@ -539,85 +1019,51 @@ def handle_search(message):
         )
         return
     
-    bot.send_chat_action(message.chat.id, 'typing')
+    await bot.send_chat_action(message.chat.id, 'typing')
     
     # Выполняем поиск и обрабатываем результаты
     results = search_in_knowledge_base(query)
-    process_search_results(message.chat.id, query, results, is_search=True)
+    await process_search_results(message.chat.id, query, results, is_search=True)
 
-@bot.message_handler(func=lambda message: message.text == "Старт 🚀")
-def start_over(message):
+@bot.message_handler(func=lambda message: message.text == BTN_START)
+async def start_over(message):
     """Начать сначала"""
-    send_welcome(message)
+    await send_welcome(message)
 
-@bot.message_handler(func=lambda message: message.text == "На главную 🏠")
-def go_home(message):
+@bot.message_handler(func=lambda message: message.text == BTN_HOME)
+async def go_home(message):
     """Вернуться на главную (к первой теме)"""
     user_id = message.from_user.id
     session = get_user_session(user_id)
-    session["current_topic"] = "start"
-    session["current_question_index"] = 0
-    show_question(user_id, message.chat.id)
+    session.current_topic = "start"
+    session.current_question_index = 0
+    await show_question(user_id, message.chat.id)
 
-@bot.message_handler(func=lambda message: message.text == "Назад ◀️")
-def go_back(message):
+@bot.message_handler(func=lambda message: message.text == BTN_BACK)
+async def go_back(message):
     """Перейти к предыдущей теме"""
-    user_id = message.from_user.id
-    session = get_user_session(user_id)
-    
-    try:
-        current_index = TOPIC_ORDER.index(session["current_topic"])
-    except ValueError:
-        # Если тема не найдена в порядке, возвращаемся на старт
-        session["current_topic"] = "start"
-        session["current_question_index"] = 0
-        show_question(user_id, message.chat.id)
-        return
-
-    if current_index > 0:
-        session["current_topic"] = TOPIC_ORDER[current_index - 1]
-        session["current_question_index"] = 0
-        show_question(user_id, message.chat.id)
-    else:
-        bot.send_message(message.chat.id, "Вы уже в начале обучения!")
+    await _navigate(message, _retreat_topic)
 
-@bot.message_handler(func=lambda message: message.text == "Предыдущий вопрос ↩️")
-def prev_question(message):
+@bot.message_handler(func=lambda message: message.text == BTN_PREV)
+async def prev_question(message):
     """Показать предыдущий вопрос в текущей теме"""
     user_id = message.from_user.id
     session = get_user_session(user_id)
-    if session["current_question_index"] > 0:
-        session["current_question_index"] -= 1
-        show_question(user_id, message.chat.id)
+    if session.current_question_index > 0:
+        session.current_question_index -= 1
+        await show_question(user_id, message.chat.id)
     else:
-        bot.send_message(message.chat.id, "Это первый вопрос в теме.")
+        await bot.send_message(message.chat.id, "Это первый вопрос в теме.")
 
-@bot.message_handler(func=lambda message: message.text == "Следующая тема ➡️")
-def next_topic(message):
+@bot.message_handler(func=lambda message: message.text == BTN_NEXT)
+async def next_topic(message):
     """Перейти к следующей теме"""
-    user_id = message.from_user.id
-    session = get_user_session(user_id)
-    
-    try:
-        current_index = TOPIC_ORDER.index(session["current_topic"])
-    except ValueError:
-        # Если тема не найдена в порядке, возвращаемся на старт
-        session["current_topic"] = "start"
-        session["current_question_index"] = 0
-        show_question(user_id, message.chat.id)
-        return
-
-    if current_index < len(TOPIC_ORDER) - 1:
-        session["current_topic"] = TOPIC_ORDER[current_index + 1]
-        session["current_question_index"] = 0
-        show_question(user_id, message.chat.id)
-    else:
-        bot.send_message(message.chat.id, "Поздравляю! Вы завершили базовый курс! 🎉")
+    await _navigate(message, _advance_topic)
 
-@bot.message_handler(func=lambda message: message.text == "Задать вопрос ❓")
-def ask_question_prompt(message):
+@bot.message_handler(func=lambda message: message.text == BTN_ASK)
+async def ask_question_prompt(message):
     """Подсказка для задавания вопроса"""
-    bot.send_message(
+    await bot.send_message(
         message.chat.id,
         "💬 *Задай свой вопрос о тестировании!*\n\n"
         "*Примеры вопросов:*\n"
@@ -632,96 +1078,45 @@ def ask_question_prompt(message):
         reply_markup=create_keyboard(with_home=True)
     )
 
-@bot.message_handler(func=lambda message: message.text == "📋 Команды")
-def show_commands_button(message):
+@bot.message_handler(func=lambda message: message.text == BTN_COMMANDS)
+async def show_commands_button(message):
     """Показать команды при нажатии кнопки"""
-    send_help(message)
+    await send_help(message)
 
-@bot.message_handler(func=lambda message: message.text == "📖 Список тем")
-def show_topics_button(message):
+@bot.message_handler(func=lambda message: message.text == BTN_TOPICS)
+async def show_topics_button(message):
     """Показать темы при нажатии кнопки"""
-    send_topics(message)
+    await send_topics(message)
+
+# Тексты кнопок - обрабатываются отдельными обработчиками
+_BUTTON_TEXTS = frozenset({BTN_START, BTN_HOME, BTN_BACK, BTN_PREV, BTN_NEXT, BTN_ASK, BTN_COMMANDS, BTN_TOPICS})
+
+# Команды и приветствия в свободном тексте - целыми словами (текст уже в нижнем регистре),
+# чтобы "ок" не находилось в "блок", а "hi" - в "this"
+_CONTINUE_RE = re.compile(r'\b(?:продолжай|дальше|next|ок|окей|ok|продолжить|вперед|далее|следующий|продолжи)\b')
+_BACK_RE = re.compile(r'\b(?:назад|предыдущая|previous|back|вернуться)\b')
+_HELLO_RE = re.compile(r'\b(?:привет\w*|здравств\w*|hello|hi)\b')
+_THANKS_RE = re.compile(r'\b(?:спасиб\w*|благодар\w*)\b')
 
 @bot.message_handler(func=lambda message: True)
-def handle_text(message):
+async def handle_text(message):
     """Обработчик текстовых сообщений (для произвольных вопросов)"""
-    user_input = message.text.lower()
+    user_input = message.text.casefold()
 
     # Если пользователь просто нажал на кнопку, она уже обработана выше
-    button_texts = ["Старт 🚀", "На главную 🏠", "Назад ◀️", "Предыдущий вопрос ↩️", 
-                    "Следующая тема ➡️", "Задать вопрос ❓", "📋 Команды", "📖 Список тем"]
-    if message.text in button_texts:
+    if message.text in _BUTTON_TEXTS:
         return
 
     # Команды для продолжения обучения (без "следующая тема" - она для разделов)
-    continue_words = ["продолжай", "дальше", "next", "ок", "окей", "ok", 
-                      "продолжить", "вперед", "далее", "следующий", "продолжи"]
-    if any(word in user_input for word in continue_words):
+    if _CONTINUE_RE.search(user_input):
         # Переходим к следующему вопросу или следующей теме
-        user_id = message.from_user.id
-        session = get_user_session(user_id)
-        topic_key = session["current_topic"]
-        question_index = session["current_question_index"]
-        
-        topic = TOPICS[topic_key]
-        is_last_question = question_index >= len(topic["content"]) - 1
-        
-        if is_last_question:
-            # Последний вопрос в теме - переходим к следующей теме
-            try:
-                current_index = TOPIC_ORDER.index(topic_key)
-            except ValueError:
-                session["current_topic"] = "start"
-                session["current_question_index"] = 0
-                show_question(user_id, message.chat.id)
-                return
-            
-            if current_index < len(TOPIC_ORDER) - 1:
-                session["current_topic"] = TOPIC_ORDER[current_index + 1]
-                session["current_question_index"] = 0
-                show_question(user_id, message.chat.id)
-            else:
-                bot.send_message(message.chat.id, "Поздравляю! Вы завершили базовый курс! 🎉")
-        else:
-            # Не последний вопрос - показываем следующий вопрос в текущей теме
-            session["current_question_index"] += 1
-            show_question(user_id, message.chat.id)
+        await _navigate(message, _advance_question)
         return
     
     # Команды для возврата назад
-    back_words = ["назад", "предыдущая", "previous", "back", "вернуться"]
-    if any(word in user_input for word in back_words):
-        user_id = message.from_user.id
-        session = get_user_session(user_id)
-        question_index = session["current_question_index"]
-        
-        if question_index > 0:
-            # Возврат к предыдущему вопросу в теме
-            session["current_question_index"] -= 1
-            show_question(user_id, message.chat.id)
-        else:
-            # Первый вопрос - переходим к предыдущей теме
-            try:
-                current_index = TOPIC_ORDER.index(session["current_topic"])
-            except ValueError:
-                session["current_topic"] = "start"
-                session["current_question_index"] = 0
-                show_question(user_id, message.chat.id)
-                return
-            
-            if current_index > 0:
-                prev_topic = TOPIC_ORDER[current_index - 1]
-                if prev_topic in TOPICS:
-                    session["current_topic"] = prev_topic
-                    prev_topic_data = TOPICS[prev_topic]
-                    session["current_question_index"] = len(prev_topic_data["content"]) - 1
-                    show_question(user_id, message.chat.id)
-                else:
-                    session["current_topic"] = "start"
-                    session["current_question_index"] = 0
-                    show_question(user_id, message.chat.id)
-            else:
-                bot.send_message(message.chat.id, "Вы уже в начале обучения!")
+    if _BACK_RE.search(user_input):
+        # Возврат к предыдущему вопросу или к последнему вопросу предыдущей темы
+        await _navigate(message, _retreat_question)
         return
 
     # Валидация и очистка пользовательского ввода
@@ -729,7 +1124,7 @@ def handle_text(message):
     user_text, is_valid, error_msg = validate_and_sanitize_input(raw_user_text)
     
     if not is_valid:
-        bot.send_message(
+        await bot.send_message(
             message.chat.id,
             f"⚠️ {error_msg}\n\n"
             "Пожалуйста, переформулируй вопрос.",
@@ -738,13 +1133,11 @@ def handle_text(message):
         return
     
     # Ответ на произвольный вопрос пользователя
-    bot.send_chat_action(message.chat.id, 'typing')
-    import time
-    time.sleep(0.5)
+    await bot.send_chat_action(message.chat.id, 'typing')
 
     # Простые приветствия и благодарности
-    if any(word in user_input for word in ["привет", "здравств", "hello", "hi"]):
-        bot.send_message(
+    if _HELLO_RE.search(user_input):
+        await bot.send_message(
             message.chat.id, 
             "Привет! 👋 Я здесь, чтобы помочь тебе с тестированием.\n\n"
             "Можешь задавать вопросы в свободной форме или использовать команды:\n"
@@ -755,13 +1148,57 @@ def handle_text(message):
         )
         return
     
-    elif any(word in user_input for word in ["спасибо", "благодар"]):
-        bot.send_message(message.chat.id, "Всегда рад помочь! Удачи в обучении! 💪")
+    elif _THANKS_RE.search(user_input):
+        await bot.send_message(message.chat.id, "Всегда рад помочь! Удачи в обучении! 💪")
         return
     
     # Интеллектуальный поиск по базе знаний и обработка результатов
     results = search_in_knowledge_base(user_text)
-    process_search_results(message.chat.id, user_text, results)
+    await process_search_results(message.chat.id, user_text, results)
+
+async def run_bot():
+    """Проверяет подключение к Telegram и получает обновления до остановки бота"""
+    try:
+        # Проверка доступности бота через getMe
+        bot_info = await bot.get_me()
+        if bot_info:
+            print(f"✓ Бот успешно подключен!")
+            print(f"  Имя: {bot_info.first_name}")
+            if bot_info.username:
+                print(f"  Username: @{bot_info.username}")
+            print()
+            print("Бот готов к работе! Найдите его в Telegram:")
+            if bot_info.username:
+                print(f"  https://t.me/{bot_info.username}")
+            print()
+    except Exception as e:
+        print(f"[ОШИБКА] Не удалось проверить подключение!")
+        print(f"Детали: {e}")
+        print()
+        print("Возможные причины:")
+        print("1. Неверный токен - проверьте файл .env")
+        print("2. Проблемы с интернет-соединением")
+        print("3. Telegram API недоступен")
+        print()
+        print("Продолжаю попытку подключения...")
+        print()
+    
+    # Заранее открываем соединение с OpenAI, чтобы первый ответ AI не ждал рукопожатия
+    # (ссылка на задачу держится, пока бот работает)
+    warm_up_task = ai_helper.start_warm_up()
+    
+    # skip_pending - не разбирать накопившиеся за время простоя сообщения после перезапуска
+    # request_timeout больше времени ожидания getUpdates, чтобы long polling не обрывался по таймауту
+    polling_timeout = config.TELEGRAM_CONFIG['polling_timeout']
+    try:
+        await bot.infinity_polling(
+            skip_pending=True,
+            timeout=polling_timeout,
+            request_timeout=polling_timeout + config.TELEGRAM_CONFIG['request_timeout']
+        )
+    finally:
+        # Итоги работы: какие модели отвечали и сколько токенов потрачено
+        ai_helper.log_stats()
 
 # Запуск бота
 if __name__ == "__main__":
@@ -802,32 +1239,7 @@ if __name__ == "__main__":
     print()
     
     try:
-        # Проверка доступности бота через getMe
-        bot_info = bot.get_me()
-        if bot_info:
-            print(f"✓ Бот успешно подключен!")
-            print(f"  Имя: {bot_info.first_name}")
-            if bot_info.username:
-                print(f"  Username: @{bot_info.username}")
-            print()
-            print("Бот готов к работе! Найдите его в Telegram:")
-            if bot_info.username:
-                print(f"  https://t.me/{bot_info.username}")
-            print()
-    except Exception as e:
-        print(f"[ОШИБКА] Не удалось проверить подключение!")
-        print(f"Детали: {e}")
-        print()
-        print("Возможные причины:")
-        print("1. Неверный токен - проверьте файл .env")
-        print("2. Проблемы с интернет-соединением")
-        print("3. Telegram API недоступен")
-        print()
-        print("Продолжаю попытку подключения...")
-        print()
-    
-    try:
-        bot.infinity_polling(none_stop=True, interval=0, timeout=20, long_polling_timeout=20)
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         print()
         print("Бот остановлен пользователем.")
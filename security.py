@@ -2,20 +2,23 @@
 Модуль безопасности для Telegram-бота QA Ментор
 Защита от промпт-хакинга, инъекций и других уязвимостей
 """
+import functools
 import re
 import html
+from collections import namedtuple
 
 
-# Паттерны промпт-хакинга (на русском и английском)
-PROMPT_INJECTION_PATTERNS = [
+# Паттерны промпт-хакинга (на русском и английском); кортеж - паттерны компилируются при загрузке
+# модуля (см. ниже), изменения списка после этого ни на что бы не повлияли
+PROMPT_INJECTION_PATTERNS = (
     # Игнорирование инструкций
-    r'игнорир[уй]й?\s+(предыдущ|все|эти)\s+инструкц',
+    r'игнорир[уй]й?\s+(предыдущ\w*|все|эти)\s+инструкц',
     r'ignore\s+(previous|all|these)\s+instructions?',
     r'forget\s+(previous|all|everything)',
     r'забудь\s+(предыдущ|все|это)',
     
     # Системные промпты
-    r'системн[ыйойая]\s+промпт',
+    r'системн\w*\s+промпт',
     r'system\s+prompt',
     r'you\s+are\s+(now|a|an)',
     r'ты\s+(теперь|сейчас)\s+(есть|являешься)',
@@ -47,14 +50,51 @@ PROMPT_INJECTION_PATTERNS = [
     r'\[instruction\]',
     r'\[prompt\]',
     r'#\s*(system|instruction|prompt)',
-]
+)
 
 # Подозрительные символы и паттерны
-SUSPICIOUS_PATTERNS = [
+SUSPICIOUS_PATTERNS = (
     r'[<>{}[\]\\|`]',  # Специальные символы
-    r'(.)\1{10,}',  # Повторяющиеся символы (возможная DoS атака)
+    r'(.)\1{10}',  # Повторяющиеся символы (возможная DoS атака): достаточно найти 11 подряд
     r'\x00',  # Null байты
-]
+)
+
+# Паттерны компилируются один раз при загрузке модуля, а не при каждой проверке сообщения
+# (отдельные паттерны быстрее одного объединенного regex: с IGNORECASE в объединении
+# каждая альтернатива пробуется в каждой позиции текста)
+_PROMPT_INJECTION_COMPILED = tuple(re.compile(pattern, re.IGNORECASE) for pattern in PROMPT_INJECTION_PATTERNS)
+_SUSPICIOUS_COMPILED = tuple(re.compile(pattern) for pattern in SUSPICIOUS_PATTERNS)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Специальные символы Markdown
+# Telegram Markdown: * _ ` [ ] ( )
+_MD_V1_CHARS = '*_`[]()'
+# MarkdownV2 требует экранирования больше символов
+_MD_V2_CHARS = '_*[]()~`>#+-=|{}.!'
+
+# Пары (символ, экранированный символ) и класс символов для быстрой проверки,
+# есть ли в тексте что экранировать
+_MD_V1_ESCAPES = tuple((char, '\\' + char) for char in _MD_V1_CHARS)
+_MD_V2_ESCAPES = tuple((char, '\\' + char) for char in _MD_V2_CHARS)
+_MD_V1_SPECIAL_RE = re.compile(f'[{re.escape(_MD_V1_CHARS)}]')
+_MD_V2_SPECIAL_RE = re.compile(f'[{re.escape(_MD_V2_CHARS)}]')
+
+
+def _escape_chars(text, escapes, special_re):
+    """Экранирует символы из escapes; строка копируется только для символов, которые в ней есть"""
+    # В большинстве сообщений спецсимволов нет - один проход regex вместо проверки каждого символа
+    if not special_re.search(text):
+        return text
+    for char, escaped in escapes:
+        # Проверка "in" быстрее replace и не создает новую строку, если символа нет
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+# Результат sanitize_input: распаковывается как прежний кортеж (sanitized_text, is_valid, error_message)
+SafetyVerdict = namedtuple('SafetyVerdict', 'sanitized is_valid error_message')
+
 
 # Максимальная длина запроса
 MAX_QUERY_LENGTH = 500
@@ -62,6 +102,10 @@ MAX_QUERY_LENGTH = 500
 # Максимальная длина для поиска
 MAX_SEARCH_LENGTH = 300
 
+# Текст длиннее этого считается подозрительным без проверки паттернами
+# (защита от DoS для вызовов в обход sanitize_input, где длина проверяется раньше)
+MAX_INSPECT_LENGTH = 2 * MAX_QUERY_LENGTH
+
 
 def escape_markdown(text):
     """
@@ -77,13 +121,7 @@ def escape_markdown(text):
         return ""
     
     # Экранируем специальные символы Markdown
-    # Telegram Markdown: * _ ` [ ] ( )
-    escape_chars = ['*', '_', '`', '[', ']', '(', ')']
-    
-    for char in escape_chars:
-        text = text.replace(char, '\\' + char)
-    
-    return text
+    return _escape_chars(text, _MD_V1_ESCAPES, _MD_V1_SPECIAL_RE)
 
 
 def escape_markdown_v2(text):
@@ -99,21 +137,16 @@ def escape_markdown_v2(text):
     if not text:
         return ""
     
-    # MarkdownV2 требует экранирования больше символов
-    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    
-    for char in escape_chars:
-        text = text.replace(char, '\\' + char)
-    
-    return text
+    return _escape_chars(text, _MD_V2_ESCAPES, _MD_V2_SPECIAL_RE)
 
 
-def detect_prompt_injection(text):
+def detect_prompt_injection(text, max_length=MAX_INSPECT_LENGTH):
     """
     Обнаруживает попытки промпт-хакинга в тексте
     
     Args:
         text: Текст для проверки
+        max_length: Текст длиннее считается подозрительным без проверки паттернами
         
     Returns:
         tuple: (is_suspicious, reason) - флаг подозрительности и причина
@@ -121,17 +154,19 @@ def detect_prompt_injection(text):
     if not text:
         return False, None
     
-    text_lower = text.lower()
+    # Слишком длинный текст не прогоняем через регулярные выражения
+    if len(text) > max_length:
+        return True, f"Текст слишком длинный для проверки (больше {max_length} символов)"
     
-    # Проверяем паттерны промпт-хакинга
-    for pattern in PROMPT_INJECTION_PATTERNS:
-        if re.search(pattern, text_lower, re.IGNORECASE):
-            return True, f"Обнаружен подозрительный паттерн: {pattern}"
+    # Проверяем паттерны промпт-хакинга (регистр не учитывается - флаг IGNORECASE,
+    # копия текста в нижнем регистре не нужна)
+    for pattern in _PROMPT_INJECTION_COMPILED:
+        if pattern.search(text):
+            return True, f"Обнаружен подозрительный паттерн: {pattern.pattern}"
     
     # Проверяем подозрительные символы
-    for pattern in SUSPICIOUS_PATTERNS:
-        if re.search(pattern, text):
-            return True, f"Обнаружены подозрительные символы"
+    if any(pattern.search(text) for pattern in _SUSPICIOUS_COMPILED):
+        return True, f"Обнаружены подозрительные символы"
     
     return False, None
 
@@ -166,10 +201,10 @@ def sanitize_input(text, max_length=MAX_QUERY_LENGTH, check_injection=True):
         check_injection: Проверять ли на промпт-хакинг
         
     Returns:
-        tuple: (sanitized_text, is_valid, error_message)
+        SafetyVerdict: (sanitized_text, is_valid, error_message)
     """
     if not text:
-        return "", False, "Ввод не может быть пустым"
+        return SafetyVerdict("", False, "Ввод не может быть пустым")
     
     # Удаляем начальные и конечные пробелы
     text = text.strip()
@@ -177,23 +212,38 @@ def sanitize_input(text, max_length=MAX_QUERY_LENGTH, check_injection=True):
     # Проверка длины
     is_valid, error = validate_query_length(text, max_length)
     if not is_valid:
-        return text[:max_length], False, error
+        return SafetyVerdict(text[:max_length], False, error)
     
     # Проверка на промпт-хакинг
     if check_injection:
-        is_suspicious, reason = detect_prompt_injection(text)
+        # Длина уже проверена выше - лимит не должен отклонять допустимый запрос
+        is_suspicious, reason = _detect_cached(text, max(max_length, MAX_INSPECT_LENGTH))
         if is_suspicious:
             # Логируем попытку (в будущем можно добавить логирование)
             # Пока просто обрезаем подозрительные части или отклоняем
-            return text, False, "Обнаружен подозрительный запрос. Пожалуйста, переформулируйте вопрос."
+            return SafetyVerdict(text, False, "Обнаружен подозрительный запрос. Пожалуйста, переформулируйте вопрос.")
     
-    # Удаляем null байты
-    text = text.replace('\x00', '')
+    # Удаляем null байты (при проверке на промпт-хакинг они уже отклонены - обычно их нет,
+    # и строка не копируется); после удаления по краям могли остаться пробелы
+    if '\x00' in text:
+        text = text.replace('\x00', '').strip()
     
     # Ограничиваем количество пробелов подряд
-    text = re.sub(r'\s+', ' ', text)
+    text = _WHITESPACE_RE.sub(' ', text)
+    
+    return SafetyVerdict(text, True, None)
+
+
+@functools.lru_cache(maxsize=1024)
+def _detect_cached(text, max_length):
+    """
+    detect_prompt_injection с запоминанием результата
     
-    return text, True, None
+    Общий кэш для sanitize_input и is_safe_for_display: текст, уже проверенный
+    при очистке ввода, при проверке перед отображением не сканируется заново
+    (как и частые вопросы). Вызывать только для текста, длина которого уже проверена.
+    """
+    return detect_prompt_injection(text, max_length)
 
 
 def safe_format_message(text, user_query=None):
@@ -228,15 +278,10 @@ def is_safe_for_display(text):
     if not text:
         return True
     
-    # Проверяем на промпт-хакинг
-    is_suspicious, _ = detect_prompt_injection(text)
-    if is_suspicious:
-        return False
-    
-    # Проверяем длину
+    # Проверяем длину до кэша: длинные тексты не проверяются паттернами и не занимают кэш
     is_valid, _ = validate_query_length(text)
     if not is_valid:
         return False
     
-    return True
-
+    is_suspicious, _ = _detect_cached(text, MAX_INSPECT_LENGTH)
+    return not is_suspicious
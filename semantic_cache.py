@@ -0,0 +1,223 @@
+"""
+Семантический кэш ответов AI
+Возвращает сохраненный ответ, если новый вопрос совпадает с уже заданным
+или близок к нему по смыслу (косинусная близость эмбеддингов)
+
+На диске кэш хранится как данные, а не как объекты Python: вопросы и ответы - в JSON,
+эмбеддинги - в .npy рядом (np.load с allow_pickle=False). Загрузка чужого или
+испорченного файла не выполняет код.
+"""
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+def cache_key(question, scope=''):
+    """Ключ точного совпадения: SHA-256 от области кэша и нормализованного вопроса"""
+    return hashlib.sha256(f"{scope}\n{question.strip().lower()}".encode()).hexdigest()
+
+class SemanticCache:
+    """
+    Кэш ответов с поиском ближайшего вопроса по эмбеддингу
+
+    Записи хранятся в порядке последнего использования (LRU) и удаляются
+    по истечении ttl секунд или при превышении max_size. Область (scope) разделяет
+    ответы, полученные по-разному (например, с другим промптом или моделью):
+    ответ находится только для вопроса из той же области.
+    """
+
+    def __init__(self, threshold=0.92, ttl=7 * 24 * 3600, max_size=1000, path=None, save_interval=60):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        # key -> (embedding, question, answer, ts, scope); эмбеддинг хранится нормированным
+        self._entries = OrderedDict()
+        # scope -> (матрица эмбеддингов, ключи ее строк); собирается при первом поиске в области
+        self._matrices = {}
+        self._loaded = False
+        self._dirty = False
+        self._last_save = time.time()
+
+    def _ensure_loaded(self):
+        """Лениво загружает кэш с диска при первом обращении"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path:
+            return
+        atexit.register(self.save)
+        if not os.path.exists(self.path):
+            return
+        try:
+            self._entries = self._read()
+            self._purge_expired()
+        except Exception as e:
+            print(f"[WARNING] Semantic cache not loaded: {e}")
+            self._entries = OrderedDict()
+
+    def _is_expired(self, entry, now):
+        return now - entry[3] > self.ttl
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if self._is_expired(entry, now)]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._invalidate()
+
+    def _invalidate(self):
+        self._matrices = {}
+        self._dirty = True
+
+    def _build_matrix(self, scope):
+        """Собирает матрицу эмбеддингов области для поиска одним умножением"""
+        keys = [key for key, entry in self._entries.items() if entry[0] is not None and entry[4] == scope]
+        matrix = np.vstack([self._entries[key][0] for key in keys]) if keys else None
+        self._matrices[scope] = (matrix, keys)
+        return self._matrices[scope]
+
+    def _hit(self, key):
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][2]
+
+    def get_exact(self, question, scope=''):
+        """Возвращает ответ на дословно совпадающий вопрос из области scope или None"""
+        self._ensure_loaded()
+        key = cache_key(question, scope)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry, time.time()):
+            del self._entries[key]
+            self._invalidate()
+            return None
+        return self._hit(key)
+
+    def get_similar(self, embedding, scope=''):
+        """Возвращает ответ на ближайший по смыслу вопрос из области scope, если близость >= threshold"""
+        self._ensure_loaded()
+        matrix, keys = self._matrices.get(scope) or self._build_matrix(scope)
+        if matrix is None:
+            self.misses += 1
+            return None
+        query = _normalize(embedding)
+        sims = matrix @ query
+        best = int(np.argmax(sims))
+        key = keys[best]
+        entry = self._entries.get(key)
+        if sims[best] < self.threshold or entry is None or self._is_expired(entry, time.time()):
+            self.misses += 1
+            return None
+        return self._hit(key)
+
+    def put(self, question, answer, embedding=None, scope=''):
+        """Сохраняет ответ в области scope; embedding может быть None - тогда доступно только точное совпадение"""
+        self._ensure_loaded()
+        vector = _normalize(embedding) if embedding is not None else None
+        key = cache_key(question, scope)
+        self._entries[key] = (vector, question, answer, time.time(), scope)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._invalidate()
+
+    def save_due(self):
+        """Пора ли сохранить кэш: он изменился, и с прошлого сохранения прошло save_interval секунд"""
+        return bool(self.path) and self._dirty and time.time() - self._last_save >= self.save_interval
+
+    def _take_snapshot(self):
+        """Копия записей для сохранения (None - сохранять нечего); копия не меняется, пока пишется файл"""
+        if not self.path or not self._dirty:
+            return None
+        self._dirty = False
+        self._last_save = time.time()
+        return OrderedDict(self._entries)
+
+    def _matrix_path(self):
+        """Файл эмбеддингов: путь кэша с расширением .npy"""
+        return os.path.splitext(self.path)[0] + '.npy'
+
+    def _read(self):
+        """Читает записи из JSON и эмбеддинги из .npy"""
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        matrix = None
+        matrix_path = self._matrix_path()
+        if os.path.exists(matrix_path):
+            matrix = np.load(matrix_path, allow_pickle=False)
+            # Эмбеддинги от другого сохранения (запись оборвалась между файлами) не используются
+            if hashlib.sha256(matrix.tobytes()).hexdigest() != data['embeddings_sha256']:
+                print("[WARNING] Semantic cache embeddings do not match entries, only exact matches are loaded")
+                matrix = None
+        entries = OrderedDict()
+        for record in data['entries']:
+            row = record['row']
+            vector = matrix[row] if matrix is not None and row is not None else None
+            scope = record['scope']
+            entries[cache_key(record['question'], scope)] = (
+                vector, record['question'], record['answer'], record['ts'], scope
+            )
+        return entries
+
+    def _write(self, entries):
+        """
+        Пишет эмбеддинги и записи во временные файлы и заменяет ими файлы кэша
+
+        Оборванная запись не портит кэш: сначала заменяется .npy, затем JSON
+        с контрольной суммой эмбеддингов - по ней _read отбрасывает несовпадающие.
+        """
+        try:
+            records = []
+            vectors = []
+            for vector, question, answer, ts, scope in entries.values():
+                row = None
+                if vector is not None:
+                    row = len(vectors)
+                    vectors.append(vector)
+                records.append({'question': question, 'answer': answer, 'ts': ts, 'scope': scope, 'row': row})
+            matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+            matrix_path = self._matrix_path()
+            with open(matrix_path + '.tmp', 'wb') as f:
+                np.save(f, matrix, allow_pickle=False)
+            os.replace(matrix_path + '.tmp', matrix_path)
+
+            data = {'embeddings_sha256': hashlib.sha256(matrix.tobytes()).hexdigest(), 'entries': records}
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as e:
+            self._dirty = True
+            print(f"[WARNING] Semantic cache not saved: {e}")
+
+    def save(self):
+        """Сохраняет кэш на диск, если он изменился (синхронно - при завершении процесса)"""
+        entries = self._take_snapshot()
+        if entries is not None:
+            self._write(entries)
+
+    async def save_async(self):
+        """Сохраняет кэш в отдельном потоке, не блокируя event loop (запись - несколько МБ)"""
+        entries = self._take_snapshot()
+        if entries is not None:
+            await asyncio.to_thread(self._write, entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+def _normalize(embedding):
+    """Приводит вектор к единичной длине, чтобы косинус считался скалярным произведением"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,105 @@
+"""
+Префиксное дерево (trie) для поиска слов по префиксу
+Используется для сопоставления слов запроса с ключами синонимов с учетом окончаний
+"""
+
+# Ключ узла, под которым хранится значение слова (символы всегда непустые)
+_VALUE = ''
+
+
+class Trie:
+    """
+    Префиксное дерево строк со значениями
+
+    Поиск слова и перебор слов с заданным префиксом - за O(длины префикса)
+    плюс число найденных слов, без просмотра всего словаря.
+    """
+
+    def __init__(self, items=()):
+        self._root = {}
+        self._size = 0
+        for word, value in items:
+            self[word] = value
+
+    def __setitem__(self, word, value):
+        node = self._root
+        for char in word:
+            node = node.setdefault(char, {})
+        if _VALUE not in node:
+            self._size += 1
+        node[_VALUE] = value
+
+    def _find(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def get(self, word, default=None):
+        node = self._find(word)
+        if node is None or _VALUE not in node:
+            return default
+        return node[_VALUE]
+
+    def __contains__(self, word):
+        node = self._find(word)
+        return node is not None and _VALUE in node
+
+    def __len__(self):
+        return self._size
+
+    def items(self, prefix=''):
+        """Перебирает пары (слово, значение) для всех слов, начинающихся с prefix"""
+        node = self._find(prefix)
+        if node is None:
+            return
+        stack = [(prefix, node)]
+        while stack:
+            word, node = stack.pop()
+            for char, child in node.items():
+                if char == _VALUE:
+                    yield word, child
+                else:
+                    stack.append((word + char, child))
+
+    def fuzzy_items(self, word, max_distance):
+        """
+        Перебирает тройки (слово, значение, расстояние) для слов дерева,
+        отличающихся от word не больше чем на max_distance правок (расстояние Левенштейна)
+
+        При спуске по дереву на каждый узел считается одна строка таблицы расстояний
+        от префикса узла до word; ветви, где минимум строки больше max_distance,
+        отсекаются - общий префикс слов считается один раз, а не для каждого слова.
+        """
+        first_row = list(range(len(word) + 1))
+        stack = [('', self._root, first_row)]
+        while stack:
+            prefix, node, row = stack.pop()
+            if _VALUE in node and row[-1] <= max_distance:
+                yield prefix, node[_VALUE], row[-1]
+            for char, child in node.items():
+                if char == _VALUE:
+                    continue
+                next_row = [row[0] + 1]
+                for i, word_char in enumerate(word, 1):
+                    next_row.append(min(
+                        next_row[i - 1] + 1,  # вставка
+                        row[i] + 1,  # удаление
+                        row[i - 1] + (word_char != char)  # замена
+                    ))
+                if min(next_row) <= max_distance:
+                    stack.append((prefix + char, child, next_row))
+
+    def longest_prefix(self, word):
+        """Возвращает самое длинное слово дерева, являющееся началом word, или None"""
+        node = self._root
+        longest = None
+        for i, char in enumerate(word):
+            node = node.get(char)
+            if node is None:
+                break
+            if _VALUE in node:
+                longest = word[:i + 1]
+        return longest